@@ -0,0 +1,222 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import io
+import logging
+import sys
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from simple_websocket import ConnectionClosed
+
+from main import WebApp
+
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# the one websocket route, /ws/<username>
+WEBSOCKET_PREFIX = '/ws/'
+
+
+def _environ(scope: Scope, body: bytes) -> Dict[str, Any]:
+    """Build the WSGI environ of an ASGI HTTP request."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI strings carry the raw bytes as latin-1
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+
+    return environ
+
+
+class WebSocket:
+    """An ASGI websocket with simple_websocket's `send` and `close`, so the FanoutHub's writer
+    threads can deliver to it like to any other socket; frames are sent on the event loop."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, send: Send) -> None:
+        self.__loop = loop
+        self.__send = send
+        self.__pending: Set[Future] = set()
+        self.__lock = threading.Lock()
+
+    def __call(self, message: Dict[str, Any]):
+        future = asyncio.run_coroutine_threadsafe(self.__send(message), self.__loop)
+        with self.__lock:
+            self.__pending.add(future)
+        try:
+            future.result()
+        except Exception as e:
+            # the client went away, the socket was already closed or the send was aborted
+            raise ConnectionClosed(message=str(e)) from e
+        finally:
+            with self.__lock:
+                self.__pending.discard(future)
+
+    def abort(self):
+        """Cancel the sends in flight, e.g. to a client that stopped reading, and close the socket."""
+        with self.__lock:
+            pending = list(self.__pending)
+        for future in pending:
+            future.cancel()
+
+        # not waited for; the server closes the connection on its own close timeout if need be
+        asyncio.run_coroutine_threadsafe(self.__send({'type': 'websocket.close', 'code': 1011, 'reason': 'Send timeout'}), self.__loop)
+
+    def send(self, data: str):
+        self.__call({'type': 'websocket.send', 'text': data})
+
+    def close(self, reason: Optional[int] = None, message: Optional[str] = None):
+        self.__call({'type': 'websocket.close', 'code': reason or 1000, 'reason': message or ''})
+
+
+class AsgiApp:
+    """Serves a WebApp from an ASGI server such as uvicorn.
+
+    Websockets live on the event loop, so an open socket costs a coroutine rather than a
+    thread and one process can hold tens of thousands of them. HTTP requests still run the
+    Flask views, each on one of `http_workers` threads, and stream their response back
+    chunk by chunk as the view produces it; a client that has not taken a chunk after
+    `send_timeout` seconds gives its thread back.
+    """
+
+    def __init__(self, web_app: WebApp, http_workers: int = 32, send_timeout: float = 30.0) -> None:
+        self.__app = web_app
+        self.__send_timeout = send_timeout
+        self.__executor = ThreadPoolExecutor(http_workers, thread_name_prefix='asgi-http')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'http':
+            await self.__http(scope, receive, send)
+        elif scope['type'] == 'websocket':
+            await self.__websocket(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.__lifespan(receive, send)
+
+    async def __lifespan(self, receive: Receive, send: Send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.__executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+
+                return
+
+    async def __http(self, scope: Scope, receive: Receive, send: Send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_running_loop()
+        environ = _environ(scope, bytes(body))
+
+        def call(message: Dict[str, Any]):
+            future = asyncio.run_coroutine_threadsafe(send(message), loop)
+            try:
+                future.result(self.__send_timeout)
+            finally:
+                # a no-op unless the send timed out
+                future.cancel()
+
+        # the whole response is produced on one thread: Flask keeps the request context of a
+        # streamed response in context variables, which do not follow a generator between threads
+        def respond():
+            # held back until the first chunk, as WSGI lets a view call start_response again until then
+            response_start: Optional[Dict[str, Any]] = None
+
+            def start_response(status: str, headers: List[Tuple[str, str]], exc_info=None):
+                nonlocal response_start
+                response_start = {
+                    'type': 'http.response.start',
+                    'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+                }
+
+                return write
+
+            def write(data: bytes, more_body: bool = True):
+                nonlocal response_start
+                if response_start is not None:
+                    call(response_start)
+                    response_start = None
+                call({'type': 'http.response.body', 'body': data, 'more_body': more_body})
+
+            response = self.__app(environ, start_response)
+            try:
+                for chunk in response:
+                    if chunk:
+                        write(chunk)
+                write(b'', more_body=False)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+
+        try:
+            await loop.run_in_executor(self.__executor, respond)
+        except Exception:
+            logging.exception('Unhandled error.')
+
+    async def __websocket(self, scope: Scope, receive: Receive, send: Send):
+        if (await receive())['type'] != 'websocket.connect':
+            return
+
+        username = scope['path'][len(WEBSOCKET_PREFIX):]
+        if not scope['path'].startswith(WEBSOCKET_PREFIX) or not username or '/' in username:
+            # closing before accepting rejects the handshake
+            await send({'type': 'websocket.close', 'code': 1000})
+
+            return
+
+        await send({'type': 'websocket.accept'})
+
+        loop = asyncio.get_running_loop()
+        # registering may reach the broker's database, so keep it off the event loop
+        connection = await loop.run_in_executor(self.__executor, self.__app.open_websocket, username, WebSocket(loop, send))
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(receive(), self.__app.ws_idle_timeout)
+                except asyncio.TimeoutError:
+                    await send({'type': 'websocket.close', 'code': 1000, 'reason': 'Idle timeout'})
+
+                    break
+
+                if message['type'] == 'websocket.disconnect':
+                    break
+        finally:
+            await loop.run_in_executor(self.__executor, self.__app.close_websocket, connection)
@@ -0,0 +1,55 @@
+"""Time and peak memory of reading a whole group chat, e.g. `python -m bench.group_messages_memory`.
+
+To compare with another revision, check it out and point --source at it, e.g.
+`git worktree add /tmp/before <commit>` and `--source /tmp/before`.
+"""
+import argparse
+from datetime import datetime, timedelta
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure get_group_messages on a large group with tracemalloc.')
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--members', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5, help='runs to take the best of')
+    parser.add_argument('--source', help='directory to import database and models from, e.g. an older checkout')
+    args = parser.parse_args()
+
+    if args.source:
+        sys.path.insert(0, os.path.abspath(args.source))
+    # imported late so that --source takes effect
+    from database import Database
+    from models import GroupChat, Message, User
+
+    database = Database(os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    members = [User(f'u{i}', f'User {i}') for i in range(args.members)]
+    for user in members:
+        database.create_user(user)
+    database.create_group_chat('g', [user.handle for user in members])
+
+    start = datetime(2024, 1, 1)
+    for i in range(args.messages):
+        database.create_group_message(Message('x' * 80, members[i % len(members)], start + timedelta(seconds=i), None), GroupChat('g'))
+
+    best_time, best_peak = float('inf'), float('inf')
+    for _ in range(args.repeat):
+        tracemalloc.start()
+        begin = time.perf_counter()
+        messages = database.get_group_messages('g')
+        elapsed = time.perf_counter() - begin
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del messages
+
+        best_time, best_peak = min(best_time, elapsed), min(best_peak, peak)
+
+    print(f'{args.messages} messages: {best_time * 1000:.0f} ms, peak {best_peak / 1e6:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
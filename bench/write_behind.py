@@ -0,0 +1,66 @@
+"""Messages per second with and without write-behind, e.g. `python -m bench.write_behind`."""
+import argparse
+from datetime import datetime
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Tuple
+
+from database import Database
+from models import GroupChat, Message, User
+
+
+def run(threads: int, messages: int, synchronous: str, write_behind: bool, write_batch_interval: float) -> Tuple[float, Dict[str, int]]:
+    """Send `messages` from `threads` threads, 3 of every 4 to a 50-member group, and return msg/s and the writer stats."""
+    directory = tempfile.mkdtemp()
+    database = Database(os.path.join(directory, 'bench.db'),
+                        pool_size=threads + 2,
+                        pragmas={'synchronous': synchronous},
+                        write_behind=write_behind,
+                        write_batch_interval=write_batch_interval,
+                        checkpoint_interval=None)
+    users = [database.create_user(User(f'u{i}', f'User {i}')) for i in range(50)]
+    database.create_group_chat('busy', [user.handle for user in users])
+
+    def send(n: int):
+        for i in range(messages // threads):
+            sender = users[n % len(users)]
+            if i % 4:
+                database.create_group_message(Message(f'message {n} {i}', sender, datetime.now(), None), GroupChat('busy'))
+            else:
+                database.create_private_message(Message(f'message {n} {i}', sender, datetime.now(), None), users[(n + 1) % len(users)])
+
+    senders = [threading.Thread(target=send, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    elapsed = time.perf_counter() - start
+
+    stats = database.writer_stats()
+    database.close()
+
+    return threads * (messages // threads) / elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare message throughput with and without write-behind.')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--messages', type=int, default=4000, help='messages sent per run, split between the threads')
+    parser.add_argument('--synchronous', nargs='+', default=['NORMAL', 'FULL'])
+    parser.add_argument('--write-batch-interval', type=float, default=0.0, help='seconds the writer waits for a batch to fill')
+    args = parser.parse_args()
+
+    print('synchronous  threads  msg/s without -> with write-behind (average batch size)')
+    for synchronous in args.synchronous:
+        for threads in args.threads:
+            without, _ = run(threads, args.messages, synchronous, False, args.write_batch_interval)
+            with_, stats = run(threads, args.messages, synchronous, True, args.write_batch_interval)
+            batch_size = stats['writes'] / max(stats['batches'], 1)
+            print(f'{synchronous:11}  {threads:7}  {without:,.0f} -> {with_:,.0f} ({batch_size:.1f})')
+
+
+if __name__ == '__main__':
+    main()
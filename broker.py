@@ -0,0 +1,246 @@
+import logging
+from queue import Empty, Queue
+import sqlite3
+import threading
+import time
+from typing import Callable, FrozenSet, List, Optional, Set, Tuple
+import uuid
+
+
+Deliver = Callable[[str, str], None]
+
+
+class Broker:
+    """Carries websocket frames between the `WebApp` processes that hold each user's sockets.
+
+    A worker subscribes for the users it has sockets for, and publishes frames for users
+    that other workers may hold. `deliver(username, frame)` is called for every frame a
+    peer publishes to one of this worker's subscribed users.
+    """
+
+    def start(self, deliver: Deliver):
+        raise NotImplementedError
+
+    def subscribe(self, username: str):
+        raise NotImplementedError
+
+    def unsubscribe(self, username: str):
+        raise NotImplementedError
+
+    def has_remote_subscribers(self, username: str) -> bool:
+        raise NotImplementedError
+
+    def publish(self, username: str, frame: str):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class InMemoryBroker(Broker):
+    """Connects workers living in the same process.
+
+    Pass an existing broker as `bus` to join its bus, e.g. to run several `WebApp`s in one test.
+    """
+
+    def __init__(self, bus: Optional['InMemoryBroker'] = None) -> None:
+        self.__peers: List[InMemoryBroker] = bus.__peers if bus is not None else []
+        self.__lock: threading.Lock = bus.__lock if bus is not None else threading.Lock()
+        self.__usernames: Set[str] = set()
+        self.__deliver: Optional[Deliver] = None
+
+    def start(self, deliver: Deliver):
+        self.__deliver = deliver
+        with self.__lock:
+            self.__peers.append(self)
+
+    def subscribe(self, username: str):
+        self.__usernames.add(username)
+
+    def unsubscribe(self, username: str):
+        self.__usernames.discard(username)
+
+    def has_remote_subscribers(self, username: str) -> bool:
+        return any(username in peer.__usernames for peer in self.__peers if peer is not self)
+
+    def publish(self, username: str, frame: str):
+        for peer in self.__peers:
+            if peer is not self and username in peer.__usernames:
+                peer.__deliver(username, frame)
+
+    def close(self):
+        with self.__lock:
+            if self in self.__peers:
+                self.__peers.remove(self)
+
+
+CREATE_BROKER_WORKER = '''CREATE TABLE IF NOT EXISTS broker_worker(
+    id VARCHAR PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);'''
+
+CREATE_BROKER_SUBSCRIPTION = '''CREATE TABLE IF NOT EXISTS broker_subscription(
+    worker_id VARCHAR NOT NULL,
+    username VARCHAR NOT NULL,
+    PRIMARY KEY (username, worker_id)
+) WITHOUT ROWID;'''
+
+CREATE_BROKER_FRAME = '''CREATE TABLE IF NOT EXISTS broker_frame(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin_id VARCHAR NOT NULL,
+    recipient VARCHAR NOT NULL,
+    frame VARCHAR NOT NULL,
+    created REAL NOT NULL
+);'''
+
+
+class SqliteBroker(Broker):
+    """Connects workers on one host through a shared SQLite file.
+
+    Published frames are appended to a table that every worker tails every `poll_interval`
+    seconds. Frames older than `retention` seconds, and workers that stopped heartbeating,
+    are purged periodically.
+
+    The other workers' subscriptions are reloaded on every poll, so `has_remote_subscribers`
+    and `publish` never touch SQLite on the caller's thread: `publish` only queues the frame,
+    and a publisher thread inserts everything queued since its last write in one transaction.
+    """
+
+    def __init__(self,
+                 path: str = 'broker.db',
+                 poll_interval: float = 0.05,
+                 retention: float = 60) -> None:
+        self.__id = uuid.uuid4().hex
+        self.__poll_interval = poll_interval
+        self.__retention = retention
+        self.__usernames: Set[str] = set()
+        # usernames subscribed by live peers, replaced as a whole by the poller
+        self.__remote_usernames: FrozenSet[str] = frozenset()
+        self.__outbox: 'Queue[Optional[Tuple[str, str]]]' = Queue()
+
+        self.__con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__con.execute('PRAGMA journal_mode = WAL;')
+        self.__con.execute('PRAGMA synchronous = NORMAL;')
+        self.__con.execute('PRAGMA busy_timeout = 5000;')
+        self.__lock = threading.Lock()
+
+        for command in [CREATE_BROKER_WORKER, CREATE_BROKER_SUBSCRIPTION, CREATE_BROKER_FRAME]:
+            self.__con.execute(command)
+
+        self.__closed = threading.Event()
+        self.__poller = None
+        self.__publisher = None
+
+    def __execute(self, query: str, params: tuple = ()) -> list:
+        with self.__lock:
+            return self.__con.execute(query, params).fetchall()
+
+    def start(self, deliver: Deliver):
+        self.__execute('INSERT OR REPLACE INTO broker_worker(id, heartbeat) VALUES (?, ?);', (self.__id, time.time()))
+        # only frames published from now on are of interest
+        last_id = self.__execute('SELECT COALESCE(MAX(id), 0) FROM broker_frame;')[0][0]
+        self.__load_remote_usernames()
+
+        self.__poller = threading.Thread(target=self.__poll,
+                                         args=(deliver, last_id),
+                                         name='broker-poller',
+                                         daemon=True)
+        self.__poller.start()
+        self.__publisher = threading.Thread(target=self.__publish_queued, name='broker-publisher', daemon=True)
+        self.__publisher.start()
+
+    def subscribe(self, username: str):
+        self.__usernames.add(username)
+        self.__execute('INSERT OR IGNORE INTO broker_subscription(worker_id, username) VALUES (?, ?);', (self.__id, username))
+
+    def unsubscribe(self, username: str):
+        self.__usernames.discard(username)
+        self.__execute('DELETE FROM broker_subscription WHERE worker_id = ? AND username = ?;', (self.__id, username))
+
+    def has_remote_subscribers(self, username: str) -> bool:
+        return username in self.__remote_usernames
+
+    def publish(self, username: str, frame: str):
+        if username in self.__remote_usernames:
+            self.__outbox.put((username, frame))
+
+    def __load_remote_usernames(self):
+        self.__remote_usernames = frozenset(username for username, in self.__execute('''SELECT DISTINCT broker_subscription.username
+FROM broker_subscription
+INNER JOIN broker_worker
+ON broker_worker.id = broker_subscription.worker_id
+WHERE broker_subscription.worker_id != ?
+AND broker_worker.heartbeat > ?;''', (self.__id, time.time() - self.__retention)))
+
+    def __publish_queued(self):
+        closed = False
+        while not closed:
+            frames = [self.__outbox.get()]
+            # whatever was queued meanwhile goes into the same transaction
+            while True:
+                try:
+                    frames.append(self.__outbox.get_nowait())
+                except Empty:
+                    break
+
+            closed = None in frames
+            rows = [(self.__id, username, frame, time.time()) for username, frame in filter(None, frames)]
+            if not rows:
+                continue
+
+            try:
+                with self.__lock:
+                    self.__con.execute('BEGIN;')
+                    try:
+                        self.__con.executemany('INSERT INTO broker_frame(origin_id, recipient, frame, created) VALUES (?, ?, ?, ?);', rows)
+                        self.__con.execute('COMMIT;')
+                    except:
+                        self.__con.execute('ROLLBACK;')
+                        raise
+            except sqlite3.Error:
+                logging.exception('Broker publish failed.')
+
+    def __poll(self, deliver: Deliver, last_id: int):
+        last_purge = time.time()
+        while not self.__closed.wait(self.__poll_interval):
+            try:
+                rows = self.__execute('''SELECT id, recipient, frame
+FROM broker_frame
+WHERE id > ?
+AND origin_id != ?
+ORDER BY id;''', (last_id, self.__id))
+
+                for frame_id, recipient, frame in rows:
+                    last_id = frame_id
+                    if recipient in self.__usernames:
+                        deliver(recipient, frame)
+
+                self.__load_remote_usernames()
+
+                now = time.time()
+                if now - last_purge > self.__retention / 2:
+                    last_purge = now
+                    self.__purge(now)
+            except sqlite3.Error:
+                logging.exception('Broker poll failed.')
+
+    def __purge(self, now: float):
+        expired = now - self.__retention
+        self.__execute('UPDATE broker_worker SET heartbeat = ? WHERE id = ?;', (now, self.__id))
+        self.__execute('DELETE FROM broker_frame WHERE created < ?;', (expired,))
+        self.__execute('''DELETE FROM broker_subscription
+WHERE worker_id IN (SELECT id FROM broker_worker WHERE heartbeat < ?);''', (expired,))
+        self.__execute('DELETE FROM broker_worker WHERE heartbeat < ?;', (expired,))
+
+    def close(self):
+        self.__closed.set()
+        if self.__poller is not None:
+            self.__poller.join()
+        if self.__publisher is not None:
+            # publish what is still queued first
+            self.__outbox.put(None)
+            self.__publisher.join()
+
+        self.__execute('DELETE FROM broker_subscription WHERE worker_id = ?;', (self.__id,))
+        self.__execute('DELETE FROM broker_worker WHERE id = ?;', (self.__id,))
+        self.__con.close()
@@ -0,0 +1,38 @@
+import argparse
+import sys
+import time
+
+from database import BULK_BATCH_SIZE, Database
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import or export the whole database as NDJSON, one record per line.')
+    parser.add_argument('command', choices=('import', 'export'))
+    parser.add_argument('file', help="NDJSON file, or '-' for stdin/stdout")
+    parser.add_argument('--database', default='database.db')
+    parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE, help='records per transaction when importing')
+    args = parser.parse_args()
+
+    database = Database(args.database, checkpoint_interval=None)
+    start = time.perf_counter()
+    try:
+        if args.command == 'export':
+            if args.file == '-':
+                counts = database.export_ndjson(sys.stdout)
+            else:
+                with open(args.file, 'w', encoding='utf-8') as stream:
+                    counts = database.export_ndjson(stream)
+        else:
+            if args.file == '-':
+                counts = database.import_ndjson(sys.stdin, args.batch_size)
+            else:
+                with open(args.file, encoding='utf-8') as stream:
+                    counts = database.import_ndjson(stream, args.batch_size)
+    finally:
+        database.close()
+
+    print(f'{args.command}ed {counts} in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
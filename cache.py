@@ -0,0 +1,56 @@
+from collections import OrderedDict
+import threading
+import time
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class LRUCache:
+    """A thread-safe, size-bounded cache whose entries also expire `ttl` seconds after being stored.
+
+    The TTL only bounds how stale an entry can get when another process writes to the
+    database; writes made through this process invalidate the affected keys explicitly.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: Optional[float] = 60) -> None:
+        self.__maxsize = maxsize
+        self.__ttl = ttl
+        self.__entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value, or None if it is missing or expired."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and (self.__ttl is None or entry[0] > time.monotonic()):
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+
+                return entry[1]
+
+            if entry is not None:
+                del self.__entries[key]
+            self.__misses += 1
+
+            return None
+
+    def put(self, key: Hashable, value: Any):
+        expires = time.monotonic() + self.__ttl if self.__ttl is not None else 0
+        with self.__lock:
+            self.__entries[key] = (expires, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__maxsize:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {'size': len(self.__entries), 'hits': self.__hits, 'misses': self.__misses}
@@ -1,10 +1,28 @@
-
-from datetime import datetime
+import asyncio
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from dataclasses import replace
+from datetime import datetime, timedelta
+import functools
+import inspect
+from itertools import islice
+import json
+import logging
+import os
 import sqlite3
-from typing import List
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple, TypeVar
+from urllib.request import pathname2url
+
+from cache import LRUCache
+from instrumentation import Instrumentation
+from models import ChatSummary, GroupChat, GroupMessage, Message, PrivateMessage, SearchResult, User
+from writer import BatchWriter
 
-from models import GroupChat, GroupMessage, Message, PrivateMessage, User
 
+T = TypeVar('T')
 
 CREATE_USER = '''CREATE TABLE IF NOT EXISTS user(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -25,12 +43,13 @@ CREATE_GROUP_CHAT = '''CREATE TABLE IF NOT EXISTS group_chat(
     name VARCHAR NOT NULL UNIQUE
 );'''
 
-CREATE_MESSAGE = '''CREATE TABLE IF NOT EXISTS message(
-    id INTEGER PRIMARY KEY AUTOINCREMENT, 
+# `{table}` is 'message' but for the rebuild in migration 9
+CREATE_MESSAGE = '''CREATE TABLE IF NOT EXISTS {table}(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
     content VARCHAR NOT NULL,
     sender_id INTEGER NOT NULL,
-    created DATETIME DEFAULT CURRENT_TIMESTAMP,
-    modified DATETIME,
+    created INTEGER NOT NULL,
+    modified INTEGER,
     CONSTRAINT fk_user FOREIGN KEY (sender_id) REFERENCES user(id) ON DELETE CASCADE
 );'''
 
@@ -61,84 +80,702 @@ CREATE_GROUP_MEMBERSHIP = '''CREATE TABLE IF NOT EXISTS group_membership(
     CONSTRAINT fk_user FOREIGN KEY (user_id) REFERENCES user(id) ON DELETE CASCADE
 );'''
 
+# timestamps are stored as integer microseconds since the epoch; datetimes are naive
+# local times, so they are counted from a naive epoch as well
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_epoch_us(value: datetime) -> int:
+    return (value - EPOCH) // MICROSECOND
+
+
+def from_epoch_us(value: int) -> datetime:
+    return EPOCH + timedelta(microseconds=value)
+
+
+# text timestamps written by sqlite3's default datetime adapter ('YYYY-MM-DD HH:MM:SS[.ffffff]')
+# converted to epoch microseconds; the fraction is taken from the text because SQLite's own
+# parsing rounds it to milliseconds
+TEXT_TO_EPOCH_US = '''CAST(strftime('%s', substr({column}, 1, 19)) AS INTEGER) * 1000000
+    + CASE WHEN length({column}) > 19 THEN CAST(substr(substr({column}, 21) || '000000', 1, 6) AS INTEGER) ELSE 0 END'''
+
+# recompute the denormalized last message pointers from the messages themselves;
+# `{where}` narrows down the chats to update
+BACKFILL_PRIVATE_CHAT_LAST_MESSAGE = '''UPDATE private_chat
+SET (last_message_id, last_activity) = (SELECT message.id, message.created
+                                        FROM private_message
+                                        INNER JOIN message
+                                        ON message.id = private_message.message_id
+                                        WHERE private_message.private_chat_id = private_chat.id
+                                        ORDER BY message.created DESC, message.id DESC
+                                        LIMIT 1)
+{where};'''
+
+BACKFILL_GROUP_CHAT_LAST_MESSAGE = '''UPDATE group_chat
+SET (last_message_id, last_activity) = (SELECT message.id, message.created
+                                        FROM group_message
+                                        INNER JOIN message
+                                        ON message.id = group_message.message_id
+                                        WHERE group_message.group_id = group_chat.id
+                                        ORDER BY message.created DESC, message.id DESC
+                                        LIMIT 1)
+{where};'''
+
+# full-text index of message contents; `scope` holds who may see each message, as tokens
+# of both participants of a private message ('u<user id>') or of its group ('g<group id>'),
+# so searches are restricted to the user's chats inside the index rather than row by row
+CREATE_MESSAGE_FTS = '''CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+    content,
+    scope,
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+);'''
+
+INDEX_PRIVATE_MESSAGE = '''INSERT INTO message_fts(rowid, content, scope)
+SELECT message.id, message.content, 'u' || message.sender_id || ' u' || private_message.recipient_id
+FROM private_message
+INNER JOIN message
+ON message.id = private_message.message_id
+{where};'''
+
+INDEX_GROUP_MESSAGE = '''INSERT INTO message_fts(rowid, content, scope)
+SELECT message.id, message.content, 'g' || group_message.group_id
+FROM group_message
+INNER JOIN message
+ON message.id = group_message.message_id
+{where};'''
+
+MESSAGE_FTS_PRIVATE_INSERT_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS message_fts_private_insert AFTER INSERT ON private_message BEGIN
+''' + INDEX_PRIVATE_MESSAGE.format(where='WHERE private_message.id = new.id') + '''
+END;'''
+
+MESSAGE_FTS_GROUP_INSERT_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS message_fts_group_insert AFTER INSERT ON group_message BEGIN
+''' + INDEX_GROUP_MESSAGE.format(where='WHERE group_message.id = new.id') + '''
+END;'''
+
+MESSAGE_FTS_UPDATE_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content ON message BEGIN
+    UPDATE message_fts SET content = new.content WHERE rowid = new.id;
+END;'''
+
+MESSAGE_FTS_DELETE_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN
+    DELETE FROM message_fts WHERE rowid = old.id;
+END;'''
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version:
+# migration N brings a database from user_version N-1 to N. Append new
+# migrations to the end of this list and never edit one that has shipped.
+MIGRATIONS = [
+    # 1: initial schema
+    [
+        CREATE_USER,
+        CREATE_GROUP_CHAT,
+        CREATE_PRIVATE_CHAT,
+        CREATE_MESSAGE.format(table='message'),
+        CREATE_GROUP_MESSAGE,
+        CREATE_PRIVATE_MESSAGE,
+        CREATE_GROUP_MEMBERSHIP,
+    ],
+    # 2: secondary indexes
+    [
+        # merge duplicated private chats so that the pair can be made unique
+        '''UPDATE private_message
+SET private_chat_id = (SELECT MIN(pc2.id)
+                       FROM private_chat pc1
+                       INNER JOIN private_chat pc2
+                       ON MIN(pc1.user1_id, pc1.user2_id) = MIN(pc2.user1_id, pc2.user2_id)
+                       AND MAX(pc1.user1_id, pc1.user2_id) = MAX(pc2.user1_id, pc2.user2_id)
+                       WHERE pc1.id = private_message.private_chat_id);''',
+        '''DELETE FROM private_chat
+WHERE id NOT IN (SELECT MIN(id)
+                 FROM private_chat
+                 GROUP BY MIN(user1_id, user2_id), MAX(user1_id, user2_id));''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_private_chat_pair ON private_chat(MIN(user1_id, user2_id), MAX(user1_id, user2_id));',
+        'CREATE INDEX IF NOT EXISTS ix_private_chat_user1 ON private_chat(user1_id);',
+        'CREATE INDEX IF NOT EXISTS ix_private_chat_user2 ON private_chat(user2_id);',
+        'CREATE INDEX IF NOT EXISTS ix_private_message_chat ON private_message(private_chat_id, message_id);',
+        'CREATE INDEX IF NOT EXISTS ix_private_message_message ON private_message(message_id);',
+        'CREATE INDEX IF NOT EXISTS ix_group_message_group ON group_message(group_id, message_id);',
+        'CREATE INDEX IF NOT EXISTS ix_group_message_message ON group_message(message_id);',
+        'CREATE INDEX IF NOT EXISTS ix_group_membership_user ON group_membership(user_id, group_id);',
+        'CREATE INDEX IF NOT EXISTS ix_group_membership_group ON group_membership(group_id, user_id);',
+        'CREATE INDEX IF NOT EXISTS ix_message_sender ON message(sender_id);',
+        'CREATE INDEX IF NOT EXISTS ix_message_created ON message(created, id);',
+    ],
+    # 3: last message pointer per chat, maintained by create_private_message/create_group_message
+    [
+        'ALTER TABLE private_chat ADD COLUMN last_message_id INTEGER REFERENCES message(id) ON DELETE SET NULL;',
+        'ALTER TABLE private_chat ADD COLUMN last_activity DATETIME;',
+        'ALTER TABLE group_chat ADD COLUMN last_message_id INTEGER REFERENCES message(id) ON DELETE SET NULL;',
+        'ALTER TABLE group_chat ADD COLUMN last_activity DATETIME;',
+        # deleting a message looks up the chats pointing at it
+        'CREATE INDEX IF NOT EXISTS ix_private_chat_last_message ON private_chat(last_message_id);',
+        'CREATE INDEX IF NOT EXISTS ix_group_chat_last_message ON group_chat(last_message_id);',
+        BACKFILL_PRIVATE_CHAT_LAST_MESSAGE.format(where=''),
+        BACKFILL_GROUP_CHAT_LAST_MESSAGE.format(where=''),
+    ],
+    # 4: per-user read markers and unread counters
+    [
+        'ALTER TABLE private_chat ADD COLUMN user1_unread INTEGER NOT NULL DEFAULT 0;',
+        'ALTER TABLE private_chat ADD COLUMN user1_last_read_message_id INTEGER;',
+        'ALTER TABLE private_chat ADD COLUMN user2_unread INTEGER NOT NULL DEFAULT 0;',
+        'ALTER TABLE private_chat ADD COLUMN user2_last_read_message_id INTEGER;',
+        'ALTER TABLE group_membership ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0;',
+        'ALTER TABLE group_membership ADD COLUMN last_read_message_id INTEGER;',
+        # the existing history counts as read
+        'UPDATE private_chat SET user1_last_read_message_id = last_message_id, user2_last_read_message_id = last_message_id;',
+        'UPDATE group_membership SET last_read_message_id = (SELECT last_message_id FROM group_chat WHERE id = group_id);',
+    ],
+    # 5: integer epoch-microsecond timestamps; ix_message_created follows the updated values
+    [
+        f"UPDATE message SET created = {TEXT_TO_EPOCH_US.format(column='created')} WHERE typeof(created) = 'text';",
+        f"UPDATE message SET modified = {TEXT_TO_EPOCH_US.format(column='modified')} WHERE typeof(modified) = 'text';",
+        'UPDATE private_chat SET last_activity = (SELECT created FROM message WHERE id = last_message_id);',
+        'UPDATE group_chat SET last_activity = (SELECT created FROM message WHERE id = last_message_id);',
+    ],
+    # 6: full-text index over message contents, maintained by triggers
+    [
+        CREATE_MESSAGE_FTS,
+        # rank by the content only; scope tokens are a filter
+        "INSERT INTO message_fts(message_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)');",
+        MESSAGE_FTS_PRIVATE_INSERT_TRIGGER,
+        MESSAGE_FTS_GROUP_INSERT_TRIGGER,
+        MESSAGE_FTS_UPDATE_TRIGGER,
+        MESSAGE_FTS_DELETE_TRIGGER,
+        # a message that left its chat, e.g. because its recipient was deleted, is no longer visible
+        '''CREATE TRIGGER IF NOT EXISTS message_fts_private_delete AFTER DELETE ON private_message BEGIN
+    DELETE FROM message_fts WHERE rowid = old.message_id;
+END;''',
+        '''CREATE TRIGGER IF NOT EXISTS message_fts_group_delete AFTER DELETE ON group_message BEGIN
+    DELETE FROM message_fts WHERE rowid = old.message_id;
+END;''',
+        INDEX_PRIVATE_MESSAGE.format(where=''),
+        INDEX_GROUP_MESSAGE.format(where=''),
+    ],
+    # 7: a copy of each message's timestamp on its chat link, so a page of history is a range scan of one index
+    [
+        'ALTER TABLE private_message ADD COLUMN created INTEGER;',
+        'ALTER TABLE group_message ADD COLUMN created INTEGER;',
+        'UPDATE private_message SET created = (SELECT created FROM message WHERE id = private_message.message_id);',
+        'UPDATE group_message SET created = (SELECT created FROM message WHERE id = group_message.message_id);',
+        'CREATE INDEX IF NOT EXISTS ix_private_message_chat_created ON private_message(private_chat_id, created, message_id);',
+        'CREATE INDEX IF NOT EXISTS ix_group_message_group_created ON group_message(group_id, created, message_id);',
+        # prefixes of the new indexes
+        'DROP INDEX IF EXISTS ix_private_message_chat;',
+        'DROP INDEX IF EXISTS ix_group_message_group;',
+    ],
+    # 8: one membership per user and group; of duplicated memberships the oldest is kept
+    [
+        '''DELETE FROM group_membership
+WHERE id NOT IN (SELECT MIN(id)
+                 FROM group_membership
+                 GROUP BY group_id, user_id);''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_group_membership_pair ON group_membership(group_id, user_id);',
+        # same columns as the new index
+        'DROP INDEX IF EXISTS ix_group_membership_group;',
+    ],
+    # 9: message.created becomes INTEGER NOT NULL, so an insert without a timestamp fails instead of storing
+    # CURRENT_TIMESTAMP text; SQLite cannot alter a column, so the table is rebuilt under the same ids
+    [
+        f"UPDATE message SET created = {TEXT_TO_EPOCH_US.format(column='created')} WHERE typeof(created) = 'text';",
+        f"UPDATE message SET modified = {TEXT_TO_EPOCH_US.format(column='modified')} WHERE typeof(modified) = 'text';",
+        # a message without a timestamp takes the one of the message before it
+        '''UPDATE message
+SET created = COALESCE((SELECT previous.created
+                        FROM message previous
+                        WHERE previous.id < message.id AND previous.created IS NOT NULL
+                        ORDER BY previous.id DESC
+                        LIMIT 1), 0)
+WHERE created IS NULL;''',
+        # renaming the new table checks every trigger, and these read the message table
+        'DROP TRIGGER message_fts_private_insert;',
+        'DROP TRIGGER message_fts_group_insert;',
+        CREATE_MESSAGE.format(table='message_new'),
+        'INSERT INTO message_new(id, content, sender_id, created, modified) SELECT id, content, sender_id, created, modified FROM message;',
+        # ids of deleted messages are not reused
+        "DELETE FROM sqlite_sequence WHERE name = 'message_new';",
+        "INSERT INTO sqlite_sequence(name, seq) SELECT 'message_new', seq FROM sqlite_sequence WHERE name = 'message';",
+        'DROP TABLE message;',
+        'ALTER TABLE message_new RENAME TO message;',
+        'CREATE INDEX IF NOT EXISTS ix_message_sender ON message(sender_id);',
+        'CREATE INDEX IF NOT EXISTS ix_message_created ON message(created, id);',
+        MESSAGE_FTS_PRIVATE_INSERT_TRIGGER,
+        MESSAGE_FTS_GROUP_INSERT_TRIGGER,
+        MESSAGE_FTS_UPDATE_TRIGGER,
+        MESSAGE_FTS_DELETE_TRIGGER,
+        # the copies of the timestamps follow the converted values
+        'UPDATE private_message SET created = (SELECT created FROM message WHERE id = message_id) WHERE created IS NOT (SELECT created FROM message WHERE id = message_id);',
+        'UPDATE group_message SET created = (SELECT created FROM message WHERE id = message_id) WHERE created IS NOT (SELECT created FROM message WHERE id = message_id);',
+        BACKFILL_PRIVATE_CHAT_LAST_MESSAGE.format(where=''),
+        BACKFILL_GROUP_CHAT_LAST_MESSAGE.format(where=''),
+    ],
+]
+
+# applied in order to the writer connection and every pooled reader connection when it is opened
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,           # ms
+    'cache_size': -16000,           # negative means KiB, i.e. ~16MB per connection
+    'mmap_size': 128 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    'wal_autocheckpoint': 1000,     # pages
+}
+
+# rows fetched per round trip when streaming messages
+FETCH_SIZE = 256
+
+# the periodic checkpoint truncates the WAL file once it has grown past this many bytes
+WAL_TRUNCATE_SIZE = 64 * 1024 * 1024
+
+# record types of the NDJSON import/export, in an order where every record only references earlier ones
+BULK_RECORD_TYPES = ('user', 'group_chat', 'group_membership', 'private_chat', 'private_message', 'group_message')
+
+BULK_BATCH_SIZE = 10000
+
+# bulk inserts with ids assigned up front, so rows can be batched with executemany
+BULK_INSERTS = {
+    'user': 'INSERT INTO user(id, handle, name) VALUES (?, ?, ?);',
+    'group_chat': 'INSERT INTO group_chat(id, name) VALUES (?, ?);',
+    'private_chat': 'INSERT INTO private_chat(id, user1_id, user2_id) VALUES (?, ?, ?);',
+    'message': 'INSERT INTO message(id, content, sender_id, created, modified) VALUES (?, ?, ?, ?, ?);',
+    'group_membership': 'INSERT INTO group_membership(group_id, user_id, is_admin) VALUES (?, ?, ?);',
+    'private_message': 'INSERT INTO private_message(message_id, created, recipient_id, private_chat_id) VALUES (?, ?, ?, ?);',
+    'group_message': 'INSERT INTO group_message(message_id, created, group_id) VALUES (?, ?, ?);',
+}
+
+# search snippets mark the matched terms with these control characters, to be replaced by the caller
+SNIPPET_MATCH_START = '\x02'
+SNIPPET_MATCH_END = '\x03'
+SNIPPET_TOKENS = 12
+
+
+def _fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query matching every word, the last one as a prefix."""
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    if terms:
+        terms[-1] += '*'
+
+    return ' '.join(terms)
+
+
+def _bulk_timestamp(value: Optional[str]) -> Optional[int]:
+    """Convert an ISO 8601 timestamp to the epoch microseconds the message table stores."""
+    return None if value is None else to_epoch_us(datetime.fromisoformat(value))
+
+
+def _row_count(result: Any) -> int:
+    """Count the items of a list or dict, a sidebar's user and chats, and any other value but None as one row."""
+    if isinstance(result, (list, dict)):
+        return len(result)
+    elif isinstance(result, tuple):
+        return sum(_row_count(item) for item in result)
+    else:
+        return int(result is not None)
+
+
+def _instrumented(method: Callable[..., T]) -> Callable[..., T]:
+    """Report the duration of a Database method and the rows it returned to the database's instrumentation."""
+    name = method.__name__
+
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def wrapped_iter(self: 'Database', *args, **kwargs):
+            items = self.instrumentation.timed('database_query_duration_seconds', method(self, *args, **kwargs), method=name)
+            rows = 0
+            try:
+                for item in items:
+                    rows += 1
+                    yield item
+            finally:
+                items.close()
+                self.instrumentation.increment('database_rows_total', rows, method=name)
+
+        return wrapped_iter
+
+    @functools.wraps(method)
+    def wrapped(self: 'Database', *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            self.instrumentation.observe('database_query_duration_seconds', time.perf_counter() - start, method=name)
+        self.instrumentation.increment('database_rows_total', _row_count(result), method=name)
+
+        return result
+
+    return wrapped
+
 
 class Database:
-    def __init__(self) -> None:
-        con = sqlite3.connect('database.db')
+    def __init__(self,
+                 path: str = 'database.db',
+                 pool_size: int = 8,
+                 pragmas: Optional[Dict[str, Any]] = None,
+                 checkpoint_interval: Optional[float] = 300,
+                 cache_size: int = 4096,
+                 cache_ttl: Optional[float] = 60,
+                 handle_index_ttl: Optional[float] = 60,
+                 write_behind: bool = False,
+                 write_batch_size: int = 64,
+                 write_batch_interval: float = 0,
+                 instrumentation: Optional[Instrumentation] = None) -> None:
+        self.__path = path
+        self.__instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        # readers open the file read-only, so only the writer thread can ever take SQLite's write lock
+        self.__read_only_uri = f'file:{pathname2url(os.path.abspath(path))}?mode=ro'
+        self.__pool_size = pool_size
+        self.__idle: List[sqlite3.Connection] = []       # most recently used last
+        # threads waiting for a connection, first come first served; a returned connection is
+        # handed to the oldest waiter directly so that busy threads cannot keep taking it back
+        self.__waiters: Deque[Future] = deque()
+        self.__opened = 0
+        self.__lock = threading.Lock()
+        self.__pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+
+        # lookups that nearly every request repeats; writes through this instance invalidate them
+        self.__users = LRUCache(cache_size, cache_ttl)             # handle -> User
+        self.__user_ids = LRUCache(cache_size, cache_ttl)          # handle -> user id
+        self.__group_ids = LRUCache(cache_size, cache_ttl)         # group name -> group id
+        self.__group_members = LRUCache(cache_size, cache_ttl)     # group name -> [User]
+
+        # every write runs on one connection in one thread, in queue order, so writers never wait
+        # on each other's locks; with write_behind, up to write_batch_size queued writes are
+        # committed in one transaction rather than one transaction each
+        self.__writer = BatchWriter(self.__open(), write_batch_size if write_behind else 1, write_batch_interval)
+
+        self.migrate()
+
+        # every handle in memory, so that existence checks never touch SQLite; kept in sync by
+        # create_user/delete_user and reloaded after handle_index_ttl to pick up other processes'
+        # writes, whose users may be reported missing until then; create_user does the exact check
+        self.__handles: Set[str] = set()
+        self.__handles_loaded = 0.0
+        self.__handles_lock = threading.Lock()
+        self.__handle_index_ttl = handle_index_ttl
+        self.__load_handles()
+
+        # the auto-checkpoint only runs on commit and never truncates the WAL file, so a periodic
+        # checkpoint catches up and truncates the file once it grows past WAL_TRUNCATE_SIZE
+        self.__closed = threading.Event()
+        self.__checkpointer = None
+        if checkpoint_interval:
+            self.__checkpointer = threading.Thread(target=self.__checkpoint_periodically,
+                                                   args=(checkpoint_interval,),
+                                                   name='database-checkpoint',
+                                                   daemon=True)
+            self.__checkpointer.start()
+
+    def __open(self, read_only: bool = False) -> sqlite3.Connection:
+        if read_only:
+            con = sqlite3.connect(self.__read_only_uri, uri=True, check_same_thread=False)
+        else:
+            con = sqlite3.connect(self.__path, check_same_thread=False)
         con.execute('PRAGMA foreign_keys = ON;')
+        for name, value in self.__pragmas.items():
+            con.execute(f'PRAGMA {name} = {value};')
 
-        # create tables if haven't already
-        for command in [CREATE_USER, 
-                        CREATE_GROUP_CHAT,
-                        CREATE_PRIVATE_CHAT,
-                        CREATE_MESSAGE, 
-                        CREATE_GROUP_MESSAGE, 
-                        CREATE_PRIVATE_MESSAGE, 
-                        CREATE_GROUP_MEMBERSHIP]:
-             con.execute(command)
+        return con
 
-    def get_users(self):
-        results = sqlite3.connect('database.db').execute('SELECT * FROM user;')
+    def __checkout(self) -> sqlite3.Connection:
+        with self.__lock:
+            if self.__idle:
+                return self.__idle.pop()
 
-        return results.fetchall()
+            can_open = self.__opened < self.__pool_size
+            if can_open:
+                self.__opened += 1
+            else:
+                waiter = Future()
+                self.__waiters.append(waiter)
 
-    def get_user_by_handle(self, handle: str) -> User:
+        if can_open:
+            try:
+                return self.__open(read_only=True)
+            except:
+                with self.__lock:
+                    self.__opened -= 1
+                raise
+
+        return waiter.result()
+
+    def __checkin(self, con: sqlite3.Connection):
+        if con.in_transaction:
+            con.rollback()
+
+        with self.__lock:
+            if not self.__waiters:
+                self.__idle.append(con)
+                return
+
+            waiter = self.__waiters.popleft()
+        waiter.set_result(con)
+
+    @contextmanager
+    def __connection(self) -> Iterator[sqlite3.Connection]:
+        """Check out a pooled read-only connection for the duration of one transaction."""
+        con = self.__checkout()
+        try:
+            with con:
+                yield con
+        finally:
+            self.__checkin(con)
+
+    def __select(self, query: str, params: tuple, paged: bool) -> Iterator[tuple]:
+        """Yield the rows of a read.
+
+        A page is fetched whole and its connection checked back in before the first row is
+        yielded, so a slow consumer, e.g. a response streamed to a slow client, cannot hold on
+        to a pooled connection. An unpaged read is fetched FETCH_SIZE rows at a time and keeps
+        its connection until the generator is exhausted or closed.
+        """
+        with self.__connection() as con:
+            cur = con.execute(query, params)
+            if not paged:
+                while rows := cur.fetchmany(FETCH_SIZE):
+                    yield from rows
+
+                return
+
+            rows = cur.fetchall()
+
+        yield from rows
+
+    def __write(self, write: Callable[[sqlite3.Connection], T], transaction: bool = True) -> T:
+        """Run `write` on the writer thread and return its result once it has committed."""
+        return self.__writer.submit(write, transaction).result()
+
+    def migrate(self) -> int:
+        """Apply pending MIGRATIONS, one transaction each, and return the resulting schema version."""
+        return self.__write(self.__migrate, transaction=False)
+
+    def __migrate(self, con: sqlite3.Connection) -> int:
+        # dropping a table that is being rebuilt would delete the rows referencing it with foreign keys on
+        con.execute('PRAGMA foreign_keys = OFF;')
+        try:
+            while True:
+                con.execute('BEGIN IMMEDIATE;')
+                # read the version inside the write lock in case another process migrated first
+                version = con.execute('PRAGMA user_version;').fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    con.rollback()
+
+                    return version
+
+                for statement in MIGRATIONS[version]:
+                    con.execute(statement)
+                con.execute(f'PRAGMA user_version = {version + 1};')
+                con.commit()
+        finally:
+            con.rollback()
+            con.execute('PRAGMA foreign_keys = ON;')
+
+    def backfill_last_messages(self):
+        """Recompute every chat's last message pointer, e.g. after messages were written behind the app's back."""
+        def backfill(con: sqlite3.Connection):
+            con.execute(BACKFILL_PRIVATE_CHAT_LAST_MESSAGE.format(where=''))
+            con.execute(BACKFILL_GROUP_CHAT_LAST_MESSAGE.format(where=''))
+
+        self.__write(backfill)
+
+    def __checkpoint_periodically(self, interval: float):
+        while not self.__closed.wait(interval):
+            try:
+                self.checkpoint('TRUNCATE' if self.__wal_size() > WAL_TRUNCATE_SIZE else 'PASSIVE')
+            except sqlite3.Error:
+                logging.exception('WAL checkpoint failed.')
+
+    def __wal_size(self) -> int:
         try:
-            result = sqlite3.connect('database.db').execute('SELECT name FROM user WHERE handle = (?);', (handle,))
-            name = result.fetchone()[0]
+            return os.path.getsize(self.__path + '-wal')
+        except OSError:
+            return 0
+
+    def checkpoint(self, mode: str = 'PASSIVE') -> Tuple[int, int, int]:
+        """Checkpoint the WAL and return SQLite's (busy, WAL pages, checkpointed pages).
+
+        The checkpoint runs on the writer thread, where every write queues behind it, so the
+        modes that wait for readers (FULL, RESTART, TRUNCATE) give up at once rather than after
+        busy_timeout; busy is then 1 and the rest is left to the next checkpoint.
+        """
+        def run(con: sqlite3.Connection) -> Tuple[int, int, int]:
+            con.execute('PRAGMA busy_timeout = 0;')
+            try:
+                return con.execute(f'PRAGMA wal_checkpoint({mode});').fetchone()
+            finally:
+                con.execute(f"PRAGMA busy_timeout = {self.__pragmas['busy_timeout']};")
+
+        return self.__write(run, transaction=False)
+
+    def close(self):
+        self.__closed.set()
+        if self.__checkpointer is not None:
+            self.__checkpointer.join()
+
+        self.__writer.close()
+
+        # open no more readers, and wait for the checked out ones to come back
+        with self.__lock:
+            opened, self.__pool_size = self.__opened, 0
+        for _ in range(opened):
+            self.__checkout().close()
+        with self.__lock:
+            self.__opened = 0
 
-            return None if name is None else User(handle, name)
-        except:
+    @property
+    def instrumentation(self) -> Instrumentation:
+        return self.__instrumentation
+
+    def writer_stats(self) -> Dict[str, int]:
+        return self.__writer.stats()
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            'users': self.__users.stats(),
+            'user_ids': self.__user_ids.stats(),
+            'group_ids': self.__group_ids.stats(),
+            'group_members': self.__group_members.stats(),
+        }
+
+    def __load_user(self, con: sqlite3.Connection, handle: str) -> Optional[User]:
+        loaded = self.__load_user_and_id(con, handle)
+
+        return None if loaded is None else loaded[0]
+
+    def __load_user_and_id(self, con: sqlite3.Connection, handle: str) -> Optional[Tuple[User, int]]:
+        """Read the user past the caches and refresh them; writes use this, as another worker may have changed the user."""
+        row = con.execute('SELECT id, name FROM user WHERE handle = (?);', (handle,)).fetchone()
+        if row is None:
+            self.__users.invalidate(handle)
+            self.__user_ids.invalidate(handle)
             return None
+
+        user = User(handle, row[1])
+        self.__users.put(handle, user)
+        self.__user_ids.put(handle, row[0])
+
+        return user, row[0]
+
+    def __user_id(self, con: sqlite3.Connection, handle: str, cached: bool = True) -> Optional[int]:
+        user_id = self.__user_ids.get(handle) if cached else None
+        if user_id is None:
+            row = con.execute('SELECT id FROM user WHERE handle = (?);', (handle,)).fetchone()
+            if row is None:
+                self.__user_ids.invalidate(handle)
+                return None
+
+            user_id = row[0]
+            self.__user_ids.put(handle, user_id)
+
+        return user_id
+
+    def __group_id(self, con: sqlite3.Connection, group_name: str, cached: bool = True) -> Optional[int]:
+        group_id = self.__group_ids.get(group_name) if cached else None
+        if group_id is None:
+            row = con.execute('SELECT id FROM group_chat WHERE name = (?);', (group_name,)).fetchone()
+            if row is None:
+                self.__group_ids.invalidate(group_name)
+                return None
+
+            group_id = row[0]
+            self.__group_ids.put(group_name, group_id)
+
+        return group_id
+
+    def __load_handles(self, ttl: Optional[float] = None):
+        with self.__handles_lock:
+            # threads that waited for the lock find the set already reloaded
+            if ttl is not None and time.monotonic() - self.__handles_loaded <= ttl:
+                return
+
+            with self.__connection() as con:
+                self.__handles = {row[0] for row in con.execute('SELECT handle FROM user;')}
+            self.__handles_loaded = time.monotonic()
+
+    def user_exists(self, handle: str) -> bool:
+        if self.__handle_index_ttl is not None and time.monotonic() - self.__handles_loaded > self.__handle_index_ttl:
+            self.__load_handles(self.__handle_index_ttl)
+
+        return handle in self.__handles
+
+    @_instrumented
+    def get_users(self):
+        with self.__connection() as con:
+            return con.execute('SELECT * FROM user;').fetchall()
+
+    @_instrumented
+    def get_user_by_handle(self, handle: str) -> User:
+        user = self.__users.get(handle)
+        if user is None:
+            with self.__connection() as con:
+                user = self.__load_user(con, handle)
+
+        return user
         
+    @_instrumented
     def get_users_in_group_chat(self, group_chat: GroupChat) -> List[User]:
-        with sqlite3.connect('database.db') as con:
-            rows = con.execute('''SELECT handle, name
+        members = self.__group_members.get(group_chat.name)
+        if members is None:
+            with self.__connection() as con:
+                rows = con.execute('''SELECT handle, name
 FROM user
 WHERE user.id IN (SELECT user_id
                   FROM group_membership
                   WHERE group_id = (SELECT id FROM group_chat WHERE name = (?)));''', (group_chat.name,)).fetchall()
-            
-            return [User(handle=row[0], name=row[1]) for row in rows]
+
+            members = [User(handle=row[0], name=row[1]) for row in rows]
+            self.__group_members.put(group_chat.name, members)
+
+        return list(members)
     
+    @_instrumented
     def create_user(self, user: User) -> User:
-        with sqlite3.connect('database.db') as con:
-            con.execute('PRAGMA foreign_keys = ON;')
-            con.execute('INSERT INTO user(handle, name) VALUES (?, ?)', (user.handle, user.name))
+        try:
+            self.__write(lambda con: con.execute('INSERT INTO user(handle, name) VALUES (?, ?)', (user.handle, user.name)))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"User '{user.handle}' already exists.")
+
+        with self.__handles_lock:
+            self.__handles.add(user.handle)
+        self.__users.invalidate(user.handle)
+        self.__user_ids.invalidate(user.handle)
 
         return self.get_user_by_handle(user.handle)
         
+    @_instrumented
     def update_user(self, user: User) -> User:
-        with sqlite3.connect('database.db') as con:
-            con.execute('PRAGMA foreign_keys = ON;')
-            con.execute('UPDATE user SET name = (?) WHERE handle = (?);', (user.name, user.handle))
+        self.__write(lambda con: con.execute('UPDATE user SET name = (?) WHERE handle = (?);', (user.name, user.handle)))
+
+        self.__users.invalidate(user.handle)
+        self.__group_members.clear()
 
+    @_instrumented
     def delete_user(self, handle: str):
-        with sqlite3.connect('database.db') as con:
-            con.execute('PRAGMA foreign_keys = ON;')
+        def delete(con: sqlite3.Connection):
             con.execute('DELETE FROM user WHERE handle = (?);', (handle,))
+            # group chats whose last message was the deleted user's now point to nothing
+            con.execute(BACKFILL_GROUP_CHAT_LAST_MESSAGE.format(where='WHERE last_message_id IS NULL'))
+
+        self.__write(delete)
+
+        with self.__handles_lock:
+            self.__handles.discard(handle)
+        self.__users.invalidate(handle)
+        self.__user_ids.invalidate(handle)
+        self.__group_members.clear()
         
+    @_instrumented
     def get_latest_private_messages_by_user(self, user_handle: str) -> List[PrivateMessage]:
-        with sqlite3.connect('database.db') as con:
-            con.execute('PRAGMA foreign_keys = ON;')
-            query = '''SELECT content, timestamp,
-(SELECT name FROM user WHERE id = sender_id) as sender_name,
-(SELECT handle FROM user WHERE id = sender_id) as sender_handle,
-(SELECT name FROM user WHERE id = (SELECT CASE WHEN user1_id = sender_id THEN user2_id ELSE user1_id END)) as recipient_name,
-(SELECT handle FROM user WHERE id = (SELECT CASE WHEN user1_id = sender_id THEN user2_id ELSE user1_id END)) as recipient_handle
-FROM (SELECT message.content, message.sender_id, MAX(message.created) as timestamp, pm.user1_id, pm.user2_id
-      FROM (SELECT private_message.message_id, pc.user1_id, pc.user2_id
-            FROM private_message
-            INNER JOIN (SELECT id, user1_id, user2_id
-                        FROM private_chat
-                        WHERE (SELECT id
-                               FROM user
-                               WHERE handle = (?)) 
-                               IN (user1_id, user2_id)) pc
-            ON private_message.private_chat_id = pc.id) pm
-      INNER JOIN message
-      ON message.id = pm.message_id
-      GROUP BY user1_id, user2_id);'''
+        with self.__connection() as con:
+            query = '''SELECT message.content, message.created, sender.name, sender.handle, recipient.name, recipient.handle
+FROM private_chat
+INNER JOIN message
+ON message.id = private_chat.last_message_id
+INNER JOIN user sender
+ON sender.id = message.sender_id
+INNER JOIN user recipient
+ON recipient.id = CASE WHEN private_chat.user1_id = message.sender_id THEN private_chat.user2_id ELSE private_chat.user1_id END
+WHERE (SELECT id FROM user WHERE handle = (?)) IN (private_chat.user1_id, private_chat.user2_id);'''
             results = con.execute(query, (user_handle,)).fetchall()
 
             return [
@@ -149,7 +786,7 @@ FROM (SELECT message.content, message.sender_id, MAX(message.created) as timesta
                             sender_handle,
                             sender_name
                         ),
-                        datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f'),
+                        from_epoch_us(timestamp),
                         None
                     ),
                     User(
@@ -159,25 +796,18 @@ FROM (SELECT message.content, message.sender_id, MAX(message.created) as timesta
                 ) for content, timestamp, sender_name, sender_handle, recipient_name, recipient_handle in results
             ]
         
+    @_instrumented
     def get_latest_group_messages_by_user(self, user_handle: str) -> List[GroupMessage]:
-        with sqlite3.connect('database.db') as con:
-            con.execute('PRAGMA foreign_keys = ON;')
-            query = '''SELECT content, timestamp,
-(SELECT name FROM user WHERE id = sender_id) as sender_name,
-(SELECT handle FROM user WHERE id = sender_id) as sender_handle,
-(SELECT name FROM group_chat WHERE id = group_id) as group_name
-FROM (SELECT message.content, message.sender_id, MAX(message.created) as timestamp, gm.group_id
-      FROM (SELECT group_message.message_id, gmb.user_id, gmb.group_id
-            FROM group_message
-            INNER JOIN (SELECT id, user_id, group_id
-                        FROM group_membership
-                        WHERE (SELECT id
-                               FROM user
-                               WHERE handle = (?)) = user_id) gmb
-            ON group_message.group_id = gmb.group_id) gm
-      INNER JOIN message
-      ON message.id = gm.message_id
-      GROUP BY gm.group_id);'''
+        with self.__connection() as con:
+            query = '''SELECT message.content, message.created, sender.name, sender.handle, group_chat.name
+FROM group_membership
+INNER JOIN group_chat
+ON group_chat.id = group_membership.group_id
+INNER JOIN message
+ON message.id = group_chat.last_message_id
+INNER JOIN user sender
+ON sender.id = message.sender_id
+WHERE group_membership.user_id = (SELECT id FROM user WHERE handle = (?));'''
             results = con.execute(query, (user_handle,)).fetchall()
 
             return [
@@ -188,7 +818,7 @@ FROM (SELECT message.content, message.sender_id, MAX(message.created) as timesta
                             sender_handle,
                             sender_name
                         ),
-                        datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f'),
+                        from_epoch_us(timestamp),
                         None
                     ),
                     GroupChat(
@@ -197,128 +827,442 @@ FROM (SELECT message.content, message.sender_id, MAX(message.created) as timesta
                 ) for content, timestamp, sender_name, sender_handle, group_name in results
             ]
         
+    @_instrumented
+    def get_sidebar(self, username: str) -> Tuple[User, List[ChatSummary]]:
+        """Return the user and every chat they are in with its latest message, most recent first."""
+        with self.__connection() as con:
+            rows = con.execute('''WITH me AS (
+    SELECT id, handle, name FROM user WHERE handle = (?)
+),
+chats AS (
+    SELECT 'private' AS kind, other.handle AS handle, other.name AS name,
+           private_chat.last_message_id AS last_message_id, private_chat.last_activity AS last_activity,
+           private_chat.user1_unread AS unread_count
+    FROM me
+    INNER JOIN private_chat
+    ON private_chat.user1_id = me.id
+    INNER JOIN user other
+    ON other.id = private_chat.user2_id
+    UNION ALL
+    SELECT 'private', other.handle, other.name, private_chat.last_message_id, private_chat.last_activity,
+           private_chat.user2_unread
+    FROM me
+    INNER JOIN private_chat
+    ON private_chat.user2_id = me.id AND private_chat.user1_id != me.id
+    INNER JOIN user other
+    ON other.id = private_chat.user1_id
+    UNION ALL
+    SELECT 'group', NULL, group_chat.name, group_chat.last_message_id, group_chat.last_activity,
+           group_membership.unread_count
+    FROM me
+    INNER JOIN group_membership
+    ON group_membership.user_id = me.id
+    INNER JOIN group_chat
+    ON group_chat.id = group_membership.group_id
+)
+SELECT me.handle, me.name, chats.kind, chats.handle, chats.name, chats.unread_count,
+       message.id, message.content, message.created, sender.handle, sender.name
+FROM me
+LEFT JOIN chats
+LEFT JOIN message
+ON message.id = chats.last_message_id
+LEFT JOIN user sender
+ON sender.id = message.sender_id
+ORDER BY chats.last_activity IS NULL, chats.last_activity DESC, chats.last_message_id DESC, chats.name;''', (username,)).fetchall()
+
+        if not rows:
+            raise ValueError(f"User '{username}' does not exist.")
+
+        user = User(rows[0][0], rows[0][1])
+        chats = []
+        for _, _, kind, handle, name, unread_count, message_id, content, created, sender_handle, sender_name in rows:
+            if kind is None:
+                continue
+
+            chats.append(ChatSummary(
+                User(handle, name) if kind == 'private' else GroupChat(name),
+                None if message_id is None else Message(
+                    content,
+                    User(sender_handle, sender_name),
+                    from_epoch_us(created),
+                    None,
+                    message_id
+                ),
+                unread_count
+            ))
+
+        return user, chats
+
+    @_instrumented
+    def search_messages(self,
+                        username: str,
+                        query: str,
+                        limit: int = 20,
+                        cursor: Optional[Tuple[float, int]] = None) -> List[SearchResult]:
+        """Return the best `limit` matches of `query` among the messages of the user's chats.
+
+        Results are ordered by bm25 rank; pass the `(rank, message id)` of the last result as
+        `cursor` to get the next ones.
+        """
+        match = _fts_query(query)
+        if not match:
+            return []
+
+        with self.__connection() as con:
+            user_id = self.__user_id(con, username)
+            if user_id is None:
+                raise ValueError(f"User '{username}' does not exist.")
+
+            scope = [f'"u{user_id}"'] + [
+                f'"g{group_id}"'
+                for group_id, in con.execute('SELECT group_id FROM group_membership WHERE user_id = (?);', (user_id,))
+            ]
+            match = f"content : ({match}) AND scope : ({' OR '.join(scope)})"
+
+            # rank every hit, but only build snippets and load messages for the page; the CROSS JOINs
+            # keep message_fts the outer loop, so the MATCH is evaluated once rather than once per row
+            rows = con.execute(f'''WITH page AS (
+    SELECT rowid AS id, rank
+    FROM message_fts
+    WHERE message_fts MATCH (?)
+    {'AND (rank, rowid) > (?, ?)' if cursor else ''}
+    ORDER BY rank, rowid
+    LIMIT ?
+)
+SELECT page.rank, snippet(message_fts, 0, ?, ?, '…', ?), message.id, message.content, message.created, message.modified,
+       sender.handle, sender.name, other.handle, other.name, group_chat.name
+FROM message_fts
+CROSS JOIN page
+ON page.id = message_fts.rowid
+CROSS JOIN message
+ON message.id = page.id
+CROSS JOIN user sender
+ON sender.id = message.sender_id
+LEFT JOIN private_message
+ON private_message.message_id = page.id
+LEFT JOIN user other
+ON other.id = CASE WHEN message.sender_id = (?) THEN private_message.recipient_id ELSE message.sender_id END
+LEFT JOIN group_message
+ON group_message.message_id = page.id
+LEFT JOIN group_chat
+ON group_chat.id = group_message.group_id
+WHERE message_fts MATCH (?)
+ORDER BY page.rank, page.id;''', (match, *(cursor or ()), limit,
+                                  SNIPPET_MATCH_START, SNIPPET_MATCH_END, SNIPPET_TOKENS, user_id, match)).fetchall()
+
+        senders: Dict[str, User] = {}
+        results = []
+        for rank, snippet, message_id, content, created, modified, sender_handle, sender_name, other_handle, other_name, group_name in rows:
+            results.append(SearchResult(
+                Message(
+                    content,
+                    senders.get(sender_handle) or senders.setdefault(sender_handle, User(sender_handle, sender_name)),
+                    from_epoch_us(created),
+                    None if modified is None else from_epoch_us(modified),
+                    message_id
+                ),
+                GroupChat(group_name) if group_name is not None else User(other_handle, other_name),
+                snippet,
+                rank
+            ))
+
+        return results
+
+    @_instrumented
+    def mark_private_chat_read(self, username: str, other_username: str):
+        self.__write(lambda con: self.__mark_private_chat_read(con, username, other_username))
+
+    def __mark_private_chat_read(self, con: sqlite3.Connection, username: str, other_username: str):
+        user_id = self.__user_id(con, username, cached=False)
+        other_id = self.__user_id(con, other_username, cached=False)
+
+        con.execute('''UPDATE private_chat
+SET user1_unread = CASE WHEN user1_id = (?) THEN 0 ELSE user1_unread END,
+    user1_last_read_message_id = CASE WHEN user1_id = (?) THEN last_message_id ELSE user1_last_read_message_id END,
+    user2_unread = CASE WHEN user2_id = (?) THEN 0 ELSE user2_unread END,
+    user2_last_read_message_id = CASE WHEN user2_id = (?) THEN last_message_id ELSE user2_last_read_message_id END
+WHERE MIN(user1_id, user2_id) = MIN(?, ?)
+AND MAX(user1_id, user2_id) = MAX(?, ?);''', (user_id, user_id, user_id, user_id, user_id, other_id, user_id, other_id))
+
+    @_instrumented
+    def mark_group_chat_read(self, username: str, group_name: str):
+        self.__write(lambda con: con.execute('''UPDATE group_membership
+SET unread_count = 0,
+    last_read_message_id = (SELECT last_message_id FROM group_chat WHERE id = group_membership.group_id)
+WHERE group_id = (SELECT id FROM group_chat WHERE name = (?))
+AND user_id = (SELECT id FROM user WHERE handle = (?));''', (group_name, username)))
+
+    @_instrumented
+    def get_private_unread_count(self, username: str, other_username: str) -> int:
+        with self.__connection() as con:
+            row = con.execute('''SELECT CASE WHEN private_chat.user1_id = me.id THEN user1_unread ELSE user2_unread END
+FROM (SELECT id FROM user WHERE handle = (?)) me,
+     (SELECT id FROM user WHERE handle = (?)) other
+INNER JOIN private_chat
+ON MIN(user1_id, user2_id) = MIN(me.id, other.id)
+AND MAX(user1_id, user2_id) = MAX(me.id, other.id);''', (username, other_username)).fetchone()
+
+            return 0 if row is None else row[0]
+
+    @_instrumented
+    def get_group_unread_counts(self, group_name: str) -> Dict[str, int]:
+        """Return the unread count of every member of the group, by handle."""
+        with self.__connection() as con:
+            rows = con.execute('''SELECT user.handle, group_membership.unread_count
+FROM group_membership
+INNER JOIN user
+ON user.id = group_membership.user_id
+WHERE group_membership.group_id = (SELECT id FROM group_chat WHERE name = (?));''', (group_name,)).fetchall()
+
+            return dict(rows)
+
+    @_instrumented
     def create_private_chat(self, user1_handle: str, user2_handle: str):
-        with sqlite3.connect('database.db') as con:
-            con.execute('PRAGMA foreign_keys = ON;')
-            user1_id = con.execute('SELECT id FROM user WHERE handle = (?);', (user1_handle)).fetchone()[0]
-            user2_id = con.execute('SELECT id FROM user WHERE handle = (?);', (user2_handle)).fetchone()[0]
+        def create(con: sqlite3.Connection):
+            user1_id = self.__user_id(con, user1_handle, cached=False)
+            user2_id = self.__user_id(con, user2_handle, cached=False)
+
+            con.execute('INSERT OR IGNORE INTO private_chat(user1_id, user2_id) VALUES (?, ?);', (user1_id, user2_id))
 
-            con.execute('INSERT INTO private_chat(user1_id, user2_id) VALUES (?, ?);', (user1_id, user2_id))
+        self.__write(create)
         
+    @_instrumented
     def create_private_message(self, message: Message, recipient: User) -> PrivateMessage:
-        with sqlite3.connect('database.db') as con:
-            con.execute('PRAGMA foreign_keys = ON;')
-            sender_id = con.execute('SELECT id FROM user WHERE handle=(?);', (message.sender.handle,)).fetchone()[0]
-            if sender_id is None:
-                raise ValueError(f"User '{message.sender.handle}' does not exist.")
+        """Store the message and return once the writer has committed it, with write_behind together with other writes."""
+        return self.__write(lambda con: self.__insert_private_message(con, message, recipient))
 
-            recipient_id = con.execute('SELECT id FROM user WHERE handle=(?);', (recipient.handle,)).fetchone()[0]
-            if recipient_id is None:
-                raise ValueError(f"User '{recipient}' does not exist.")
-            
-            cur = con.cursor()
-            row = con.execute('SELECT id FROM private_chat WHERE (user1_id = (?) AND user2_id = (?)) OR (user1_id = (?) AND user2_id = (?));',
-                                          (sender_id, recipient_id, recipient_id, sender_id)).fetchone()
-            if row is None:
-                cur.execute('INSERT INTO private_chat(user1_id, user2_id) VALUES (?, ?)', (sender_id, recipient_id))
-                private_chat_id = cur.lastrowid
-            else:
-                private_chat_id = row[0]
-            
-            cur.execute('INSERT INTO message(content, sender_id, created) VALUES (?, ? ,?);', (message.content, sender_id, message.created))
+    def __insert_private_message(self, con: sqlite3.Connection, message: Message, recipient: User) -> PrivateMessage:
+        # the message carries the current display names
+        loaded = self.__load_user_and_id(con, message.sender.handle)
+        if loaded is None:
+            raise ValueError(f"User '{message.sender.handle}' does not exist.")
+        sender, sender_id = loaded
 
-            message_id = cur.lastrowid
+        loaded = self.__load_user_and_id(con, recipient.handle)
+        if loaded is None:
+            raise ValueError(f"User '{recipient}' does not exist.")
+        recipient, recipient_id = loaded
+        
+        cur = con.cursor()
+        row = con.execute('''SELECT id
+FROM private_chat
+WHERE MIN(user1_id, user2_id) = MIN(?, ?)
+AND MAX(user1_id, user2_id) = MAX(?, ?);''', (sender_id, recipient_id, sender_id, recipient_id)).fetchone()
+        if row is None:
+            cur.execute('INSERT INTO private_chat(user1_id, user2_id) VALUES (?, ?)', (sender_id, recipient_id))
+            private_chat_id = cur.lastrowid
+        else:
+            private_chat_id = row[0]
+        
+        created = to_epoch_us(message.created)
+        cur.execute('INSERT INTO message(content, sender_id, created) VALUES (?, ? ,?);', (message.content, sender_id, created))
 
-            cur.execute('INSERT INTO private_message(message_id, recipient_id, private_chat_id) VALUES (?, ?, ?);', (message_id, recipient_id, private_chat_id))
+        message_id = cur.lastrowid
 
-    def get_private_messages(self, username1, username2):
-        with sqlite3.connect('database.db') as con:
-            con.execute('PRAGMA foreign_keys = ON;')
-            user1_id, user1_name = con.execute('SELECT id, name FROM user WHERE handle=(?);', (username1,)).fetchone()
-            if user1_id is None:
+        cur.execute('INSERT INTO private_message(message_id, created, recipient_id, private_chat_id) VALUES (?, ?, ?, ?);',
+                    (message_id, created, recipient_id, private_chat_id))
+        cur.execute('''UPDATE private_chat
+SET last_message_id = (?), last_activity = (?)
+WHERE id = (?) AND (last_activity IS NULL OR last_activity <= (?));''', (message_id, created, private_chat_id, created))
+        # the sender has read everything up to their own message; the recipient has one more unread
+        cur.execute('''UPDATE private_chat
+SET user1_unread = CASE WHEN user1_id = (?) THEN 0 ELSE user1_unread + 1 END,
+    user1_last_read_message_id = CASE WHEN user1_id = (?) THEN (?) ELSE user1_last_read_message_id END,
+    user2_unread = CASE WHEN user2_id = (?) THEN 0 ELSE user2_unread + 1 END,
+    user2_last_read_message_id = CASE WHEN user2_id = (?) THEN (?) ELSE user2_last_read_message_id END
+WHERE id = (?);''', (sender_id, sender_id, message_id, sender_id, sender_id, message_id, private_chat_id))
+
+        return PrivateMessage(replace(message, id=message_id, sender=sender), recipient)
+
+    def get_private_messages(self,
+                             username1: str,
+                             username2: str,
+                             limit: Optional[int] = None,
+                             before: Optional[Tuple[datetime, int]] = None) -> List[PrivateMessage]:
+        """Return the latest `limit` messages, optionally older than the `(created, id)` cursor `before`, oldest first."""
+        return list(self.iter_private_messages(username1, username2, limit, before))
+
+    @_instrumented
+    def iter_private_messages(self,
+                              username1: str,
+                              username2: str,
+                              limit: Optional[int] = None,
+                              before: Optional[Tuple[datetime, int]] = None) -> Iterator[PrivateMessage]:
+        """Like `get_private_messages`, but yield the messages one at a time.
+
+        With a `limit`, the page is read before the first message is yielded; without one, the
+        rows are fetched FETCH_SIZE at a time and a pooled connection stays checked out until
+        the generator is exhausted or closed.
+        """
+        with self.__connection() as con:
+            user1 = self.__users.get(username1) or self.__load_user(con, username1)
+            if user1 is None:
                 raise ValueError(f"User '{username1}' does not exist.")
+
+            user1_id = self.__user_id(con, username1)
             
-            user1 = User(username1, user1_name)
-            
-            user2_id, user2_name = con.execute('SELECT id, name FROM user WHERE handle=(?);', (username2,)).fetchone()
-            if user2_id is None:
+            user2 = self.__users.get(username2) or self.__load_user(con, username2)
+            if user2 is None:
                 raise ValueError(f"User '{username2}' does not exist.")
-            
-            user2 = User(username2, user2_name)
-            
-            query = '''SELECT message.content, message.sender_id, message.created, message.modified
-FROM message
-INNER JOIN (SELECT message_id
-            FROM private_message
-            INNER JOIN (SELECT id
-                        FROM private_chat
-                        WHERE (user1_id = (?) AND user2_id = (?))
-                        OR (user1_id = (?) AND user2_id = (?))) pc
-           	ON private_message.private_chat_id = pc.id) pm
-ON message.id = pm.message_id;'''
-            results = con.execute(query, (user1_id, user2_id, user2_id, user1_id)).fetchall()
-            
-            return [
-                PrivateMessage(
+
+            user2_id = self.__user_id(con, username2)
+
+        # the page is cut from ix_private_message_chat_created before any message is read
+        query = f'''SELECT message.content, message.sender_id, message.created, message.modified, message.id
+FROM (SELECT message_id, created
+      FROM private_message
+      WHERE private_chat_id = (SELECT id
+                               FROM private_chat
+                               WHERE MIN(user1_id, user2_id) = MIN(?, ?)
+                               AND MAX(user1_id, user2_id) = MAX(?, ?))
+      {'AND (created, message_id) < (?, ?)' if before else ''}
+      ORDER BY created DESC, message_id DESC
+      LIMIT ?) page
+INNER JOIN message
+ON message.id = page.message_id
+ORDER BY page.created, page.message_id;'''
+
+        before = (to_epoch_us(before[0]), before[1]) if before else None
+        params = (user1_id, user2_id, user1_id, user2_id, *(before or ()), -1 if limit is None else limit)
+
+        with closing(self.__select(query, params, limit is not None)) as rows:
+            for content, sender_id, created, modified, message_id in rows:
+                yield PrivateMessage(
                     Message(
                         content,
                         user1 if sender_id == user1_id else user2,
-                        datetime.strptime(created, '%Y-%m-%d %H:%M:%S.%f'),
-                        datetime.strptime(modified, '%Y-%m-%d %H:%M:%S.%f') if modified else None
+                        from_epoch_us(created),
+                        None if modified is None else from_epoch_us(modified),
+                        message_id
                     ),
                     user2 if sender_id == user1_id else user1
                 )
-                for content, sender_id, created, modified in results
-            ]
+
+    @_instrumented
+    def has_more_private_messages(self,
+                                  username1: str,
+                                  username2: str,
+                                  limit: int,
+                                  before: Optional[Tuple[datetime, int]] = None) -> bool:
+        """Whether the chat holds more than `limit` messages, optionally older than the cursor `before`."""
+        with self.__connection() as con:
+            user1_id = self.__user_id(con, username1)
+            if user1_id is None:
+                raise ValueError(f"User '{username1}' does not exist.")
+
+            user2_id = self.__user_id(con, username2)
+            if user2_id is None:
+                raise ValueError(f"User '{username2}' does not exist.")
+
+            before = (to_epoch_us(before[0]), before[1]) if before else None
+            return bool(con.execute(f'''SELECT EXISTS(SELECT 1
+              FROM private_message
+              WHERE private_chat_id = (SELECT id
+                                       FROM private_chat
+                                       WHERE MIN(user1_id, user2_id) = MIN(?, ?)
+                                       AND MAX(user1_id, user2_id) = MAX(?, ?))
+              {'AND (created, message_id) < (?, ?)' if before else ''}
+              LIMIT 1 OFFSET ?);''', (user1_id, user2_id, user1_id, user2_id, *(before or ()), limit)).fetchone()[0])
             
+    @_instrumented
     def create_group_chat(self, group_name: str, member_usernames: List[str]):
-        with sqlite3.connect('database.db') as con:
-            con.execute('PRAGMA foreign_keys = ON;')
-            con.execute('INSERT INTO group_chat(name) VALUES (?)', (group_name,))
-
-            for member in  member_usernames:
-                con.execute('''INSERT INTO group_membership(group_id, user_id) VALUES ((SELECT id
-                                                                                        FROM group_chat
-                                                                                        WHERE name = ?),
-                                                                                       (SELECT id
-                                                                                        FROM user
-                                                                                        WHERE handle = ?))''',
-                            (group_name, member))
-                
-    def get_group_messages(self, group_name: str) -> List[GroupMessage]:
-        with sqlite3.connect('database.db') as con:
-            con.execute('PRAGMA foreign_keys = ON;')
-            results = con.execute('''SELECT user.name, user.handle, m.content, m.created, m.modified
+        """Create the group and its memberships in one transaction; nothing is created if a member does not exist."""
+        handles = list(dict.fromkeys(member_usernames))
+
+        def create(con: sqlite3.Connection):
+            # resolve every handle at once; json_each keeps it to a single bound parameter
+            user_ids = dict(con.execute('''SELECT handle, id
 FROM user
-INNER JOIN (SELECT message.content, message.sender_id, message.created, message.modified
-           	FROM message
-           	INNER JOIN (SELECT group_message.message_id
-                      	FROM group_message
-                       	WHERE group_id = (SELECT id
-                                          FROM group_chat
-                                          WHERE name = (?))) gc
-           	ON gc.message_id = message.id) m
-ON m.sender_id = user.id
-ORDER BY m.created;''', (group_name,))
-            
-            return [GroupMessage(
-                Message(
-                    content=row[2],
-                    sender=User(
-                        handle=row[1],
-                        name=row[0]
+WHERE handle IN (SELECT value FROM json_each(?));''', (json.dumps(handles),)).fetchall())
+
+            unknown = [handle for handle in handles if handle not in user_ids]
+            if unknown:
+                raise ValueError(f"Users {', '.join(repr(handle) for handle in unknown)} do not exist.")
+
+            cur = con.cursor()
+            cur.execute('INSERT INTO group_chat(name) VALUES (?)', (group_name,))
+            group_id = cur.lastrowid
+
+            cur.executemany('INSERT INTO group_membership(group_id, user_id) VALUES (?, ?);',
+                            [(group_id, user_ids[handle]) for handle in handles])
+
+        self.__write(create)
+        self.__group_ids.invalidate(group_name)
+        self.__group_members.invalidate(group_name)
+                
+    def get_group_messages(self,
+                           group_name: str,
+                           limit: Optional[int] = None,
+                           before: Optional[Tuple[datetime, int]] = None) -> List[GroupMessage]:
+        """Return the latest `limit` messages, optionally older than the `(created, id)` cursor `before`, oldest first."""
+        return list(self.iter_group_messages(group_name, limit, before))
+
+    @_instrumented
+    def iter_group_messages(self,
+                            group_name: str,
+                            limit: Optional[int] = None,
+                            before: Optional[Tuple[datetime, int]] = None) -> Iterator[GroupMessage]:
+        """Like `get_group_messages`, but yield the messages one at a time.
+
+        With a `limit`, the page is read before the first message is yielded; without one, the
+        rows are fetched FETCH_SIZE at a time and a pooled connection stays checked out until
+        the generator is exhausted or closed.
+        """
+        before = (to_epoch_us(before[0]), before[1]) if before else None
+        # the page is cut from ix_group_message_group_created before any message is read
+        rows = self.__select(f'''SELECT user.name, user.handle, message.content, message.created, message.modified, message.id
+FROM (SELECT message_id, created
+      FROM group_message
+      WHERE group_id = (SELECT id
+                        FROM group_chat
+                        WHERE name = (?))
+      {'AND (created, message_id) < (?, ?)' if before else ''}
+      ORDER BY created DESC, message_id DESC
+      LIMIT ?) page
+INNER JOIN message
+ON message.id = page.message_id
+INNER JOIN user
+ON user.id = message.sender_id
+ORDER BY page.created, page.message_id;''', (group_name, *(before or ()), -1 if limit is None else limit), limit is not None)
+
+        # one User per sender and one GroupChat for the whole query rather than one per row
+        group_chat = GroupChat(name=group_name)
+        senders: Dict[str, User] = {}
+
+        with closing(rows):
+            for row in rows:
+                yield GroupMessage(
+                    Message(
+                        content=row[2],
+                        sender=senders.get(row[1]) or senders.setdefault(row[1], User(handle=row[1], name=row[0])),
+                        created=from_epoch_us(row[3]),
+                        modified=None if row[4] is None else from_epoch_us(row[4]),
+                        id=row[5]
                     ),
-                    created=datetime.strptime(row[3], '%Y-%m-%d %H:%M:%S.%f'),
-                    modified=datetime.strptime(row[4], '%Y-%m-%d %H:%M:%S.%f') if row[4] else None
-                ),
-                GroupChat(
-                    name=group_name
+                    group_chat
                 )
-            ) for row in results]
+
+    @_instrumented
+    def has_more_group_messages(self,
+                                group_name: str,
+                                limit: int,
+                                before: Optional[Tuple[datetime, int]] = None) -> bool:
+        """Whether the group holds more than `limit` messages, optionally older than the cursor `before`."""
+        before = (to_epoch_us(before[0]), before[1]) if before else None
+        with self.__connection() as con:
+            group_id = self.__group_id(con, group_name)
+            if group_id is None:
+                return False
+
+            return bool(con.execute(f'''SELECT EXISTS(SELECT 1
+              FROM group_message
+              WHERE group_id = (?)
+              {'AND (created, message_id) < (?, ?)' if before else ''}
+              LIMIT 1 OFFSET ?);''', (group_id, *(before or ()), limit)).fetchone()[0])
                 
+    @_instrumented
     def get_group_chats_by_username(self, username: str) -> List[GroupChat]:
-        with sqlite3.connect('database.db') as con:
-            con.execute('PRAGMA foreign_keys = ON;')
+        with self.__connection() as con:
             results = con.execute('''SELECT name
 FROM group_chat
 WHERE id in (SELECT group_id
@@ -329,26 +1273,449 @@ WHERE id in (SELECT group_id
             
             return [GroupChat(name=row[0]) for row in results]
         
-    def create_group_message(self, message: Message, group_chat: GroupChat):
-        with sqlite3.connect('database.db') as con:
+    @_instrumented
+    def create_group_message(self, message: Message, group_chat: GroupChat) -> GroupMessage:
+        """Store the message and return once the writer has committed it, with write_behind together with other writes."""
+        return self.__write(lambda con: self.__insert_group_message(con, message, group_chat))[0]
+
+    @_instrumented
+    def send_group_message(self, message: Message, group_chat: GroupChat) -> Tuple[GroupMessage, Dict[str, int]]:
+        """Store the message like `create_group_message`, and also return the unread count of every member, by handle."""
+        return self.__write(lambda con: self.__insert_group_message(con, message, group_chat))
+
+    def __insert_group_message(self, con: sqlite3.Connection, message: Message, group_chat: GroupChat) -> Tuple[GroupMessage, Dict[str, int]]:
+        loaded = self.__load_user_and_id(con, message.sender.handle)
+        if loaded is None:
+            raise ValueError(f"User '{message.sender.handle}' does not exist.")
+        sender, sender_id = loaded
+
+        group_id = self.__group_id(con, group_chat.name, cached=False)
+        if group_id is None:
+            raise ValueError(f"Group Chat '{group_chat}' does not exist.")
+        
+        cur = con.cursor()
+        created = to_epoch_us(message.created)
+        cur.execute('INSERT INTO message(content, sender_id, created, modified) VALUES (?,?,?,?);', (
+            message.content,
+            sender_id,
+            created,
+            None if message.modified is None else to_epoch_us(message.modified)
+        ))
+
+        message_id = cur.lastrowid
+
+        cur.execute('INSERT INTO group_message(group_id, message_id, created) VALUES (?,?,?);', (group_id, message_id, created))
+        cur.execute('''UPDATE group_chat
+SET last_message_id = (?), last_activity = (?)
+WHERE id = (?) AND (last_activity IS NULL OR last_activity <= (?));''', (message_id, created, group_id, created))
+        # the counts are read back from the updates, so the send path needs no query of its own
+        unread_counts = dict(cur.execute('''UPDATE group_membership
+SET unread_count = unread_count + 1
+WHERE group_id = (?) AND user_id != (?)
+RETURNING (SELECT handle FROM user WHERE id = group_membership.user_id), unread_count;''', (group_id, sender_id)).fetchall())
+        cur.execute('UPDATE group_membership SET unread_count = 0, last_read_message_id = (?) WHERE group_id = (?) AND user_id = (?);', (message_id, group_id, sender_id))
+        unread_counts[message.sender.handle] = 0
+
+        return GroupMessage(replace(message, id=message_id, sender=sender), group_chat), unread_counts
+
+
+    def export_ndjson(self, stream: TextIO) -> Dict[str, int]:
+        """Write every user, group, membership, private chat and message to `stream`, one JSON record per line.
+
+        Rows reference each other by handle and group name rather than by id, in an order
+        `import_ndjson` can load back. Rows are streamed, so memory use does not grow with the database.
+        """
+        counts = dict.fromkeys(BULK_RECORD_TYPES, 0)
+        queries = {
+            'user': 'SELECT handle, name FROM user ORDER BY id;',
+            'group_chat': 'SELECT name FROM group_chat ORDER BY id;',
+            'group_membership': '''SELECT group_chat.name, user.handle, group_membership.is_admin
+FROM group_membership
+INNER JOIN group_chat
+ON group_chat.id = group_membership.group_id
+INNER JOIN user
+ON user.id = group_membership.user_id
+ORDER BY group_membership.id;''',
+            'private_chat': '''SELECT user1.handle, user2.handle
+FROM private_chat
+INNER JOIN user user1
+ON user1.id = private_chat.user1_id
+INNER JOIN user user2
+ON user2.id = private_chat.user2_id
+ORDER BY private_chat.id;''',
+            'private_message': '''SELECT sender.handle, recipient.handle, message.content, message.created, message.modified
+FROM private_message
+INNER JOIN message
+ON message.id = private_message.message_id
+INNER JOIN user sender
+ON sender.id = message.sender_id
+INNER JOIN user recipient
+ON recipient.id = private_message.recipient_id
+ORDER BY message.id;''',
+            'group_message': '''SELECT group_chat.name, sender.handle, message.content, message.created, message.modified
+FROM group_message
+INNER JOIN message
+ON message.id = group_message.message_id
+INNER JOIN group_chat
+ON group_chat.id = group_message.group_id
+INNER JOIN user sender
+ON sender.id = message.sender_id
+ORDER BY message.id;''',
+        }
+        fields = {
+            'user': ('handle', 'name'),
+            'group_chat': ('name',),
+            'group_membership': ('group', 'user', 'is_admin'),
+            'private_chat': ('user1', 'user2'),
+            'private_message': ('sender', 'recipient', 'content', 'created', 'modified'),
+            'group_message': ('group', 'sender', 'content', 'created', 'modified'),
+        }
+
+        with self.__connection() as con:
+            for record_type in BULK_RECORD_TYPES:
+                cur = con.execute(queries[record_type])
+                while True:
+                    rows = cur.fetchmany(BULK_BATCH_SIZE)
+                    if not rows:
+                        break
+
+                    for row in rows:
+                        record = {'type': record_type, **dict(zip(fields[record_type], row))}
+                        for key in ('created', 'modified'):
+                            if record.get(key) is not None:
+                                record[key] = from_epoch_us(record[key]).isoformat()
+                        if 'is_admin' in record:
+                            record['is_admin'] = bool(record['is_admin'])
+
+                        stream.write(json.dumps(record, ensure_ascii=False))
+                        stream.write('\n')
+
+                    counts[record_type] += len(rows)
+
+        return counts
+
+    def import_ndjson(self, stream: Iterable[str], batch_size: int = BULK_BATCH_SIZE) -> Dict[str, int]:
+        """Load records in the `export_ndjson` format, committing every `batch_size` records.
+
+        Handles and group names are resolved through in-memory id maps, so a record may only
+        reference users and groups that already exist or appear earlier in the stream. Users,
+        groups and memberships that already exist are reused. Secondary indexes and the full-text insert
+        trigger are dropped for the duration of the import and caught up once at the end, and
+        the denormalized last message pointers of the touched chats are recomputed; imported
+        history counts as read. Every message needs a `created` timestamp; a malformed record
+        raises ValueError naming its line.
+        """
+        counts = self.__write(lambda con: self.__import_ndjson(con, stream, batch_size), transaction=False)
+
+        self.__users.clear()
+        self.__user_ids.clear()
+        self.__group_ids.clear()
+        self.__group_members.clear()
+        self.__load_handles()
+
+        return counts
+
+    def __import_ndjson(self, con: sqlite3.Connection, stream: Iterable[str], batch_size: int) -> Dict[str, int]:
+        counts = dict.fromkeys(BULK_RECORD_TYPES, 0)
+
+        def next_id(table: str) -> int:
+            return con.execute(f'SELECT COALESCE(MAX(id), 0) + 1 FROM {table};').fetchone()[0]
+
+        user_ids = dict(con.execute('SELECT handle, id FROM user;'))
+        group_ids = dict(con.execute('SELECT name, id FROM group_chat;'))
+        private_chat_ids = {
+            (min(user1_id, user2_id), max(user1_id, user2_id)): chat_id
+            for chat_id, user1_id, user2_id in con.execute('SELECT id, user1_id, user2_id FROM private_chat;')
+        }
+        memberships = set(con.execute('SELECT group_id, user_id FROM group_membership;'))
+        ids = {table: next_id(table) for table in ('user', 'group_chat', 'private_chat', 'message')}
+        touched_private_chats, touched_groups = set(), set()
+
+        rows: Dict[str, list] = {table: [] for table in BULK_INSERTS}
+
+        def flush():
+            for table, statement in BULK_INSERTS.items():
+                if rows[table]:
+                    con.executemany(statement, rows[table])
+                    rows[table].clear()
+            con.commit()
+
+        def user_id(handle: str, line_number: int) -> int:
+            if handle not in user_ids:
+                raise ValueError(f"Line {line_number}: user '{handle}' does not exist.")
+
+            return user_ids[handle]
+
+        def group_id(name: str, line_number: int) -> int:
+            if name not in group_ids:
+                raise ValueError(f"Line {line_number}: group chat '{name}' does not exist.")
+
+            return group_ids[name]
+
+        def private_chat_id(user1: int, user2: int) -> int:
+            pair = (min(user1, user2), max(user1, user2))
+            if pair not in private_chat_ids:
+                private_chat_ids[pair] = ids['private_chat']
+                rows['private_chat'].append((ids['private_chat'], user1, user2))
+                ids['private_chat'] += 1
+
+            touched_private_chats.add(private_chat_ids[pair])
+
+            return private_chat_ids[pair]
+
+        def message(sender: int, record: dict, line_number: int) -> Tuple[int, int]:
+            """Queue the message row and return its id and timestamp, which its chat link copies."""
+            if record.get('created') is None:
+                raise ValueError(f"Line {line_number}: message has no 'created' timestamp.")
+            try:
+                created = _bulk_timestamp(record['created'])
+            except (TypeError, ValueError):
+                raise ValueError(f"Line {line_number}: invalid 'created' timestamp {record['created']!r}.") from None
+            rows['message'].append((ids['message'], record['content'], sender, created, _bulk_timestamp(record.get('modified'))))
+            ids['message'] += 1
+
+            return ids['message'] - 1, created
+
+        # ids are resolved here, so the per-row foreign key checks only cost time
+        con.commit()
+        con.execute('PRAGMA foreign_keys = OFF;')
+        indexes = con.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix\\_%' ESCAPE '\\';").fetchall()
+        for name, _ in indexes:
+            con.execute(f'DROP INDEX {name};')
+        # indexing the new messages in one statement at the end is several times faster than per row
+        first_message_id = ids['message']
+        fts_triggers = con.execute('''SELECT name, sql
+FROM sqlite_master
+WHERE type = 'trigger'
+AND name IN ('message_fts_private_insert', 'message_fts_group_insert');''').fetchall()
+        for name, _ in fts_triggers:
+            con.execute(f'DROP TRIGGER {name};')
+
+        try:
+            pending = 0
+            for line_number, line in enumerate(stream, 1):
+                if not line.strip():
+                    continue
+
+                record = json.loads(line)
+                record_type = record.get('type')
+                if record_type == 'user':
+                    if record['handle'] not in user_ids:
+                        user_ids[record['handle']] = ids['user']
+                        rows['user'].append((ids['user'], record['handle'], record['name']))
+                        ids['user'] += 1
+                elif record_type == 'group_chat':
+                    if record['name'] not in group_ids:
+                        group_ids[record['name']] = ids['group_chat']
+                        rows['group_chat'].append((ids['group_chat'], record['name']))
+                        ids['group_chat'] += 1
+                elif record_type == 'group_membership':
+                    membership = (group_id(record['group'], line_number), user_id(record['user'], line_number))
+                    if membership not in memberships:
+                        memberships.add(membership)
+                        rows['group_membership'].append((*membership, int(record.get('is_admin', False))))
+                elif record_type == 'private_chat':
+                    private_chat_id(user_id(record['user1'], line_number), user_id(record['user2'], line_number))
+                elif record_type == 'private_message':
+                    sender = user_id(record['sender'], line_number)
+                    recipient = user_id(record['recipient'], line_number)
+                    chat_id = private_chat_id(sender, recipient)
+                    rows['private_message'].append((*message(sender, record, line_number), recipient, chat_id))
+                elif record_type == 'group_message':
+                    group = group_id(record['group'], line_number)
+                    touched_groups.add(group)
+                    sender = user_id(record['sender'], line_number)
+                    rows['group_message'].append((*message(sender, record, line_number), group))
+                else:
+                    raise ValueError(f"Line {line_number}: unknown record type '{record_type}'.")
+
+                counts[record_type] += 1
+                pending += 1
+                if pending >= batch_size:
+                    flush()
+                    pending = 0
+
+            flush()
+        finally:
+            con.rollback()
+            for _, sql in indexes:
+                con.execute(sql)
+            for _, sql in fts_triggers:
+                con.execute(sql)
+            if fts_triggers:
+                con.execute(INDEX_PRIVATE_MESSAGE.format(where='WHERE message.id >= (?)'), (first_message_id,))
+                con.execute(INDEX_GROUP_MESSAGE.format(where='WHERE message.id >= (?)'), (first_message_id,))
+            con.commit()
             con.execute('PRAGMA foreign_keys = ON;')
 
-            sender_id = con.execute('SELECT id FROM user WHERE handle=(?);', (message.sender.handle,)).fetchone()[0]
-            if sender_id is None:
-                raise ValueError(f"User '{message.sender.handle}' does not exist.")
+        # the backfill needs the rebuilt indexes
+        touched = (json.dumps(sorted(touched_private_chats)), json.dumps(sorted(touched_groups)))
+        con.execute(BACKFILL_PRIVATE_CHAT_LAST_MESSAGE.format(where='WHERE id IN (SELECT value FROM json_each(?))'), touched[:1])
+        con.execute(BACKFILL_GROUP_CHAT_LAST_MESSAGE.format(where='WHERE id IN (SELECT value FROM json_each(?))'), touched[1:])
+        con.execute('''UPDATE private_chat
+SET user1_last_read_message_id = last_message_id, user2_last_read_message_id = last_message_id
+WHERE id IN (SELECT value FROM json_each(?));''', touched[:1])
+        con.execute('''UPDATE group_membership
+SET last_read_message_id = (SELECT last_message_id FROM group_chat WHERE id = group_id)
+WHERE group_id IN (SELECT value FROM json_each(?));''', touched[1:])
 
-            group_id = con.execute('SELECT id FROM group_chat WHERE name=(?);', (group_chat.name,)).fetchone()[0]
-            if group_id is None:
-                raise ValueError(f"Group Chat '{group_chat}' does not exist.")
-            
-            cur = con.cursor()
-            cur.execute('INSERT INTO message(content, sender_id, created, modified) VALUES (?,?,?,?);', (
-                message.content,
-                sender_id,
-                message.created,
-                message.modified
-            ))
+        return counts
+
+
+class AsyncDatabase:
+    """Awaitable counterparts of the `Database` methods, for code running on an event loop.
+
+    Each call runs the blocking method on a dedicated pool of `max_workers` threads, so a
+    slow query holds up neither the event loop nor the other coroutines. Reads beyond the
+    database's reader pool only queue for a connection, so the extra threads mostly serve
+    callers waiting on the writer thread.
+    """
+
+    def __init__(self, database: Database, max_workers: int = 16) -> None:
+        self.__database = database
+        self.__executor = ThreadPoolExecutor(max_workers, thread_name_prefix='database-async')
+
+    @property
+    def database(self) -> Database:
+        return self.__database
+
+    async def __run(self, method: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, method, *args)
+
+    async def __iterate(self, iterator: Iterator[T]) -> AsyncIterator[T]:
+        """Drain a blocking iterator FETCH_SIZE items per executor call."""
+        try:
+            while True:
+                items = await self.__run(list, islice(iterator, FETCH_SIZE))
+                if not items:
+                    break
+
+                for item in items:
+                    yield item
+        finally:
+            # an unpaged read holds a pooled connection until its generator is closed
+            await self.__run(iterator.close)
+
+    def close(self):
+        """Wait for the calls in flight; the wrapped database stays open."""
+        self.__executor.shutdown()
+
+    async def backfill_last_messages(self):
+        return await self.__run(self.__database.backfill_last_messages)
+
+    async def checkpoint(self, mode: str = 'PASSIVE') -> Tuple[int, int, int]:
+        return await self.__run(self.__database.checkpoint, mode)
+
+    async def user_exists(self, handle: str) -> bool:
+        return await self.__run(self.__database.user_exists, handle)
+
+    async def get_users(self):
+        return await self.__run(self.__database.get_users)
+
+    async def get_user_by_handle(self, handle: str) -> User:
+        return await self.__run(self.__database.get_user_by_handle, handle)
+
+    async def get_users_in_group_chat(self, group_chat: GroupChat) -> List[User]:
+        return await self.__run(self.__database.get_users_in_group_chat, group_chat)
+
+    async def create_user(self, user: User) -> User:
+        return await self.__run(self.__database.create_user, user)
+
+    async def update_user(self, user: User) -> User:
+        return await self.__run(self.__database.update_user, user)
+
+    async def delete_user(self, handle: str):
+        return await self.__run(self.__database.delete_user, handle)
+
+    async def get_latest_private_messages_by_user(self, user_handle: str) -> List[PrivateMessage]:
+        return await self.__run(self.__database.get_latest_private_messages_by_user, user_handle)
+
+    async def get_latest_group_messages_by_user(self, user_handle: str) -> List[GroupMessage]:
+        return await self.__run(self.__database.get_latest_group_messages_by_user, user_handle)
+
+    async def get_sidebar(self, username: str) -> Tuple[User, List[ChatSummary]]:
+        return await self.__run(self.__database.get_sidebar, username)
+
+    async def search_messages(self,
+                              username: str,
+                              query: str,
+                              limit: int = 20,
+                              cursor: Optional[Tuple[float, int]] = None) -> List[SearchResult]:
+        return await self.__run(self.__database.search_messages, username, query, limit, cursor)
+
+    async def mark_private_chat_read(self, username: str, other_username: str):
+        return await self.__run(self.__database.mark_private_chat_read, username, other_username)
+
+    async def mark_group_chat_read(self, username: str, group_name: str):
+        return await self.__run(self.__database.mark_group_chat_read, username, group_name)
+
+    async def get_private_unread_count(self, username: str, other_username: str) -> int:
+        return await self.__run(self.__database.get_private_unread_count, username, other_username)
+
+    async def get_group_unread_counts(self, group_name: str) -> Dict[str, int]:
+        return await self.__run(self.__database.get_group_unread_counts, group_name)
+
+    async def create_private_chat(self, user1_handle: str, user2_handle: str):
+        return await self.__run(self.__database.create_private_chat, user1_handle, user2_handle)
+
+    async def create_private_message(self, message: Message, recipient: User) -> PrivateMessage:
+        return await self.__run(self.__database.create_private_message, message, recipient)
+
+    async def get_private_messages(self,
+                                   username1: str,
+                                   username2: str,
+                                   limit: Optional[int] = None,
+                                   before: Optional[Tuple[datetime, int]] = None) -> List[PrivateMessage]:
+        return await self.__run(self.__database.get_private_messages, username1, username2, limit, before)
+
+    async def iter_private_messages(self,
+                                    username1: str,
+                                    username2: str,
+                                    limit: Optional[int] = None,
+                                    before: Optional[Tuple[datetime, int]] = None) -> AsyncIterator[PrivateMessage]:
+        async for message in self.__iterate(self.__database.iter_private_messages(username1, username2, limit, before)):
+            yield message
+
+    async def has_more_private_messages(self,
+                                        username1: str,
+                                        username2: str,
+                                        limit: int,
+                                        before: Optional[Tuple[datetime, int]] = None) -> bool:
+        return await self.__run(self.__database.has_more_private_messages, username1, username2, limit, before)
+
+    async def create_group_chat(self, group_name: str, member_usernames: List[str]):
+        return await self.__run(self.__database.create_group_chat, group_name, member_usernames)
+
+    async def get_group_messages(self,
+                                 group_name: str,
+                                 limit: Optional[int] = None,
+                                 before: Optional[Tuple[datetime, int]] = None) -> List[GroupMessage]:
+        return await self.__run(self.__database.get_group_messages, group_name, limit, before)
+
+    async def iter_group_messages(self,
+                                  group_name: str,
+                                  limit: Optional[int] = None,
+                                  before: Optional[Tuple[datetime, int]] = None) -> AsyncIterator[GroupMessage]:
+        async for message in self.__iterate(self.__database.iter_group_messages(group_name, limit, before)):
+            yield message
+
+    async def has_more_group_messages(self,
+                                      group_name: str,
+                                      limit: int,
+                                      before: Optional[Tuple[datetime, int]] = None) -> bool:
+        return await self.__run(self.__database.has_more_group_messages, group_name, limit, before)
+
+    async def get_group_chats_by_username(self, username: str) -> List[GroupChat]:
+        return await self.__run(self.__database.get_group_chats_by_username, username)
+
+    async def create_group_message(self, message: Message, group_chat: GroupChat) -> GroupMessage:
+        return await self.__run(self.__database.create_group_message, message, group_chat)
+
+    async def send_group_message(self, message: Message, group_chat: GroupChat) -> Tuple[GroupMessage, Dict[str, int]]:
+        return await self.__run(self.__database.send_group_message, message, group_chat)
 
-            message_id = cur.lastrowid
+    async def export_ndjson(self, stream: TextIO) -> Dict[str, int]:
+        return await self.__run(self.__database.export_ndjson, stream)
 
-            cur.execute('INSERT INTO group_message(group_id, message_id) VALUES (?,?);', (group_id, message_id))
+    async def import_ndjson(self, stream: Iterable[str], batch_size: int = BULK_BATCH_SIZE) -> Dict[str, int]:
+        return await self.__run(self.__database.import_ndjson, stream, batch_size)
@@ -0,0 +1,289 @@
+from collections import deque
+import logging
+from queue import Queue
+import socket
+import threading
+import time
+from typing import Deque, Dict, List, Optional
+
+from simple_websocket import ConnectionClosed, Server
+
+from broker import Broker
+from instrumentation import Instrumentation
+
+
+# what to do with a connection whose outbound queue is full
+SLOW_CONSUMER_DROP = 'drop'                 # discard the new frame
+SLOW_CONSUMER_DISCONNECT = 'disconnect'     # close the socket; the htmx ws extension reconnects
+
+
+def _abort(ws: Server):
+    """Fail a send that is blocked on a client that stopped reading, and drop the connection."""
+    abort = getattr(ws, 'abort', None)
+    if abort is not None:
+        abort()
+    else:
+        ws.sock.shutdown(socket.SHUT_RDWR)
+
+
+class Connection:
+    """One websocket and its bounded queue of frames waiting to be sent."""
+
+    def __init__(self, username: str, ws: Server) -> None:
+        self.username = username
+        self.ws = ws
+        self.frames: Deque[str] = deque()
+        self.scheduled = False      # queued on the hub's ready queue or being drained by a writer
+        self.closed = False
+        self.disconnect = False     # closed for being too slow; the writer closes the socket
+        self.lock = threading.Lock()
+
+
+class FanoutHub:
+    """Delivers frames to websockets off the request thread.
+
+    `send` only appends to each recipient connection's queue. A small pool of writer
+    threads drains the connections that have pending frames. A socket whose send has not
+    completed after `send_timeout` seconds, e.g. a client that stopped reading, is aborted
+    so that its writer moves on; a stalled client holds up the others for at most that long.
+
+    With a `broker`, the hub subscribes for the users it holds sockets for, and `send`
+    also publishes each frame to the other workers.
+    """
+
+    def __init__(self,
+                 writers: int = 4,
+                 queue_size: int = 256,
+                 slow_consumer_policy: str = SLOW_CONSUMER_DROP,
+                 batch_size: int = 32,
+                 send_timeout: Optional[float] = 5.0,
+                 broker: Optional[Broker] = None,
+                 instrumentation: Optional[Instrumentation] = None) -> None:
+        if slow_consumer_policy not in (SLOW_CONSUMER_DROP, SLOW_CONSUMER_DISCONNECT):
+            raise ValueError(f"Unknown slow consumer policy '{slow_consumer_policy}'.")
+
+        self.__queue_size = queue_size
+        self.__policy = slow_consumer_policy
+        self.__batch_size = batch_size
+        self.__send_timeout = send_timeout
+        self.__instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+
+        # lists are replaced rather than mutated so `send` can iterate them without locking
+        self.__connections: Dict[str, List[Connection]] = {}
+        self.__lock = threading.Lock()
+        self.__ready: 'Queue[Optional[Connection]]' = Queue()
+
+        self.__stats_lock = threading.Lock()
+        self.__counters = dict.fromkeys(('frames_queued', 'frames_sent', 'frames_dropped', 'slow_consumer_disconnects', 'send_timeouts'), 0)
+
+        # connection -> deadline of the send a writer is blocked in
+        self.__sending: Dict[Connection, float] = {}
+        self.__sending_lock = threading.Lock()
+        self.__closed = threading.Event()
+        self.__reaper = None
+        if send_timeout is not None:
+            self.__reaper = threading.Thread(target=self.__reap, name='fanout-reaper', daemon=True)
+            self.__reaper.start()
+
+        self.__broker = broker
+        if broker is not None:
+            broker.start(self.send_local)
+
+        self.__writers = [
+            threading.Thread(target=self.__write, name=f'fanout-writer-{n}', daemon=True)
+            for n in range(writers)
+        ]
+        for writer in self.__writers:
+            writer.start()
+
+    def register(self, username: str, ws: Server) -> Connection:
+        connection = Connection(username, ws)
+        with self.__lock:
+            first = username not in self.__connections
+            self.__connections[username] = self.__connections.get(username, []) + [connection]
+
+        if first and self.__broker is not None:
+            self.__broker.subscribe(username)
+
+        return connection
+
+    def unregister(self, connection: Connection):
+        with connection.lock:
+            connection.closed = True
+            connection.frames.clear()
+
+        with self.__lock:
+            current = self.__connections.get(connection.username, [])
+            remaining = [c for c in current if c is not connection]
+            last = bool(current) and not remaining
+            if remaining:
+                self.__connections[connection.username] = remaining
+            else:
+                self.__connections.pop(connection.username, None)
+
+        if last and self.__broker is not None:
+            self.__broker.unsubscribe(connection.username)
+
+    def connection_count(self, username: str) -> int:
+        return len(self.__connections.get(username, []))
+
+    def is_connected(self, username: str) -> bool:
+        """Whether `username` has a socket on this worker or, through the broker, on another one."""
+        if self.__connections.get(username):
+            return True
+
+        return self.__broker is not None and self.__broker.has_remote_subscribers(username)
+
+    def send(self, username: str, frame: str) -> int:
+        """Queue `frame` for every socket of `username`, publish it to the other workers,
+        and return how many local sockets it was queued for."""
+        start = time.perf_counter()
+        if self.__broker is not None:
+            self.__broker.publish(username, frame)
+
+        queued = self.send_local(username, frame)
+        self.__instrumentation.observe('fanout_send_duration_seconds', time.perf_counter() - start)
+        self.__instrumentation.increment('fanout_sockets_total', queued)
+
+        return queued
+
+    def send_local(self, username: str, frame: str) -> int:
+        """Queue `frame` for the sockets of `username` held by this worker only."""
+        queued = 0
+        for connection in self.__connections.get(username, []):
+            if self.__enqueue(connection, frame):
+                queued += 1
+
+        return queued
+
+    def __enqueue(self, connection: Connection, frame: str) -> bool:
+        with connection.lock:
+            if connection.closed:
+                return False
+
+            full = len(connection.frames) >= self.__queue_size
+            if not full:
+                connection.frames.append(frame)
+                schedule = not connection.scheduled
+                connection.scheduled = True
+
+        if full:
+            self.__count('frames_dropped')
+            if self.__policy == SLOW_CONSUMER_DISCONNECT:
+                self.__disconnect_slow(connection)
+
+            return False
+
+        self.__count('frames_queued')
+        if schedule:
+            self.__ready.put(connection)
+
+        return True
+
+    def __count(self, name: str):
+        with self.__stats_lock:
+            self.__counters[name] += 1
+
+    def __disconnect_slow(self, connection: Connection):
+        logging.warning('Closing a slow %s websocket (%d frames pending).', connection.username, self.__queue_size)
+        self.__count('slow_consumer_disconnects')
+        with connection.lock:
+            connection.disconnect = True
+            schedule = not connection.scheduled
+            connection.scheduled = True
+
+        self.unregister(connection)
+        # closing sends a frame too, so leave it to a writer rather than blocking the request thread
+        if schedule:
+            self.__ready.put(connection)
+
+    def __write(self):
+        while True:
+            connection = self.__ready.get()
+            if connection is None:
+                return
+
+            # send at most one batch, then yield to other connections
+            for _ in range(self.__batch_size):
+                with connection.lock:
+                    if connection.closed or not connection.frames:
+                        connection.scheduled = False
+                        disconnect = connection.disconnect
+                        break
+
+                    frame = connection.frames.popleft()
+
+                try:
+                    start = time.perf_counter()
+                    self.__timed(connection, connection.ws.send, frame)
+                    self.__instrumentation.observe('websocket_send_duration_seconds', time.perf_counter() - start)
+                    self.__count('frames_sent')
+                except (ConnectionClosed, OSError):
+                    self.unregister(connection)
+                    disconnect = False
+                    break
+            else:
+                self.__ready.put(connection)
+                continue
+
+            if disconnect:
+                try:
+                    self.__timed(connection, connection.ws.close, message='Slow consumer')
+                except Exception:
+                    pass
+
+    def __timed(self, connection: Connection, send, *args, **kwargs):
+        """Call a blocking send of `connection`'s socket under the hub's send deadline."""
+        if self.__send_timeout is None:
+            return send(*args, **kwargs)
+
+        with self.__sending_lock:
+            self.__sending[connection] = time.monotonic() + self.__send_timeout
+        try:
+            return send(*args, **kwargs)
+        finally:
+            with self.__sending_lock:
+                self.__sending.pop(connection, None)
+
+    def __reap(self):
+        while not self.__closed.wait(self.__send_timeout / 4):
+            now = time.monotonic()
+            with self.__sending_lock:
+                overdue = [connection for connection, deadline in self.__sending.items() if deadline < now]
+                for connection in overdue:
+                    del self.__sending[connection]
+
+            for connection in overdue:
+                logging.warning('Aborting a %s websocket that blocked a send for %ss.', connection.username, self.__send_timeout)
+                self.__count('send_timeouts')
+                self.unregister(connection)
+                try:
+                    _abort(connection.ws)
+                except Exception:
+                    logging.exception('Aborting a websocket failed.')
+
+    def stats(self) -> Dict[str, int]:
+        connections = [c for cs in list(self.__connections.values()) for c in cs]
+        with self.__stats_lock:
+            counters = dict(self.__counters)
+
+        return {
+            'connections': len(connections),
+            'queue_depth': sum(len(c.frames) for c in connections),
+            'max_queue_depth': max((len(c.frames) for c in connections), default=0),
+            **counters,
+        }
+
+    def close(self):
+        if self.__broker is not None:
+            self.__broker.close()
+
+        for _ in self.__writers:
+            self.__ready.put(None)
+        # the reaper still aborts sends the writers are blocked in
+        for writer in self.__writers:
+            writer.join()
+
+        self.__closed.set()
+        if self.__reaper is not None:
+            self.__reaper.join()
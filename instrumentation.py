@@ -0,0 +1,215 @@
+from bisect import bisect_left
+from collections import Counter
+import math
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Set, Tuple, TypeVar
+
+
+T = TypeVar('T')
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# help text of the metrics the app reports, by name without the namespace
+HELP = {
+    'http_request_duration_seconds': 'Time to serve a request, up to the last chunk of a streamed response.',
+    'database_query_duration_seconds': 'Time spent in a Database method, including waiting for a connection or the writer.',
+    'database_rows_total': 'Rows returned by Database methods.',
+    'template_render_duration_seconds': 'Time to render a views component; streamed renders include producing their lazy values.',
+    'fanout_send_duration_seconds': "Time to queue a frame for a user's websockets and publish it to the broker.",
+    'fanout_sockets_total': 'Local websockets the frames sent by this worker were queued for.',
+    'websocket_send_duration_seconds': 'Time to write one frame to a websocket.',
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        name += '{' + ','.join(f'{key}="{_escape(str(v))}"' for key, v in labels) + '}'
+
+    return f'{name} {value!r}' if isinstance(value, float) and not value.is_integer() else f'{name} {int(value)}'
+
+
+def expose_stats(name: str, stats: Mapping[str, Any], label: Optional[str] = None) -> str:
+    """Render one of the app's `stats()` dicts in the Prometheus text format.
+
+    Stats mix counters and gauges, so every value is exposed as untyped. With `label`,
+    `stats` holds one dict per label value, like `Database.cache_stats()`.
+    """
+    series: Dict[str, List[str]] = {}
+    for key, value in stats.items():
+        if label is None:
+            series.setdefault(f'{name}_{key}', []).append(_sample(f'{name}_{key}', (), value))
+        else:
+            for inner_key, inner_value in value.items():
+                metric = f'{name}_{inner_key}'
+                series.setdefault(metric, []).append(_sample(metric, ((label, key),), inner_value))
+
+    return ''.join(f'# TYPE {metric} untyped\n' + '\n'.join(samples) + '\n' for metric, samples in series.items())
+
+
+class Instrumentation:
+    """Receives the timings and counts the app measures.
+
+    This base class discards them. Pass a `Metrics` to collect them for the /metrics
+    endpoint, or a subclass to forward them elsewhere, e.g. to a StatsD agent.
+    """
+
+    def observe(self, name: str, value: float, **labels: str):
+        """Record one sample of a distribution, e.g. a duration in seconds."""
+
+    def increment(self, name: str, value: float = 1, **labels: str):
+        """Add `value` to a counter."""
+
+    def expose(self) -> str:
+        """Return what was collected in the Prometheus text format."""
+        return ''
+
+    def timed(self, name: str, iterator: Iterator[T], **labels: str) -> Iterator[T]:
+        """Yield from `iterator` and observe the time spent producing its items, once it is
+        exhausted or closed; the consumer's time between items is not counted."""
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+
+                yield item
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+            self.observe(name, elapsed, **labels)
+
+
+class Metrics(Instrumentation):
+    """Keeps histograms and counters in memory and renders them for Prometheus to scrape."""
+
+    def __init__(self, namespace: str = 'messaging', buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.__namespace = namespace
+        self.__buckets = tuple(sorted(buckets))
+        self.__lock = threading.Lock()
+        # name -> labels -> [count per bucket..., count above the last bucket], sum
+        self.__histograms: Dict[str, Dict[Labels, Tuple[List[int], List[float]]]] = {}
+        self.__counters: Dict[str, Dict[Labels, float]] = {}
+
+    def observe(self, name: str, value: float, **labels: str):
+        index = bisect_left(self.__buckets, value)
+        key = tuple(labels.items())
+        with self.__lock:
+            series = self.__histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = ([0] * (len(self.__buckets) + 1), [0.0])
+            counts, total = series[key]
+            counts[index] += 1
+            total[0] += value
+
+    def increment(self, name: str, value: float = 1, **labels: str):
+        key = tuple(labels.items())
+        with self.__lock:
+            series = self.__counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def expose(self) -> str:
+        with self.__lock:
+            histograms = {name: {key: (list(counts), total[0]) for key, (counts, total) in series.items()}
+                          for name, series in self.__histograms.items()}
+            counters = {name: dict(series) for name, series in self.__counters.items()}
+
+        lines = []
+        for name, series in sorted(histograms.items()):
+            metric = f'{self.__namespace}_{name}'
+            if name in HELP:
+                lines.append(f'# HELP {metric} {HELP[name]}')
+            lines.append(f'# TYPE {metric} histogram')
+            for key, (counts, total) in series.items():
+                cumulative = 0
+                for bound, count in zip((*self.__buckets, math.inf), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else repr(float(bound))
+                    lines.append(_sample(f'{metric}_bucket', key + (('le', le),), cumulative))
+                lines.append(_sample(f'{metric}_sum', key, total))
+                lines.append(_sample(f'{metric}_count', key, cumulative))
+
+        for name, series in sorted(counters.items()):
+            metric = f'{self.__namespace}_{name}'
+            if name in HELP:
+                lines.append(f'# HELP {metric} {HELP[name]}')
+            lines.append(f'# TYPE {metric} counter')
+            for key, value in series.items():
+                lines.append(_sample(metric, key, value))
+
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+class SamplingProfiler:
+    """Samples the stacks of the threads it tracks every `interval` seconds.
+
+    The app tracks the threads serving the profiled route for the duration of each request.
+    `collapsed()` returns the samples in the collapsed stack format ('frame;frame;frame count'
+    per line, outermost frame first) that flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.__interval = interval
+        self.__threads: Set[int] = set()
+        self.__stacks: Counter = Counter()
+        self.__lock = threading.Lock()
+        self.__closed = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name='sampling-profiler', daemon=True)
+        self.__thread.start()
+
+    def track(self, thread_id: int):
+        with self.__lock:
+            self.__threads.add(thread_id)
+
+    def untrack(self, thread_id: int):
+        with self.__lock:
+            self.__threads.discard(thread_id)
+
+    def __run(self):
+        while not self.__closed.wait(self.__interval):
+            with self.__lock:
+                threads = list(self.__threads)
+            if not threads:
+                continue
+
+            frames = sys._current_frames()
+            stacks = []
+            for thread_id in threads:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                if stack:
+                    stacks.append(';'.join(reversed(stack)))
+
+            with self.__lock:
+                self.__stacks.update(stacks)
+
+    def collapsed(self, reset: bool = False) -> str:
+        with self.__lock:
+            stacks = self.__stacks if reset else Counter(self.__stacks)
+            if reset:
+                self.__stacks = Counter()
+
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+    def close(self):
+        self.__closed.set()
+        self.__thread.join()
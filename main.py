@@ -1,16 +1,24 @@
 from datetime import datetime
 import functools
+from html import escape
+from itertools import chain
 import logging
-from time import sleep
-from flask import Flask, request
-from importlib import import_module as imp, reload as rel
+import threading
+from time import perf_counter
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple, Union
+from urllib.parse import urlencode
+from flask import Flask, Response, g, request, stream_with_context
 
 from flask_sock import Sock, ConnectionClosed
 
 from simple_websocket import Server
 
-from database import Database
-from models import GroupChat, Message, PrivateMessage, User
+from broker import Broker
+from database import SNIPPET_MATCH_END, SNIPPET_MATCH_START, Database
+from fanout import Connection, FanoutHub
+from instrumentation import Instrumentation, Metrics, SamplingProfiler, expose_stats
+from models import GroupChat, GroupMessage, Message, PrivateMessage, User
+from templates import Markup, Templates
 
 from chope import *
 
@@ -27,15 +35,70 @@ def catch_exception(func):
     return wrapped
 
 
+# number of messages rendered per chat page
+PAGE_SIZE = 50
+
+# number of search results rendered per page
+SEARCH_PAGE_SIZE = 20
+
+
+def encode_cursor(message: Message) -> str:
+    return f'{message.id}:{message.created.isoformat()}'
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    message_id, created = cursor.split(':', 1)
+
+    return datetime.fromisoformat(created), int(message_id)
+
+
 class WebApp(Flask):
-    def __init__(self):
+    def __init__(self,
+                 database_path: str = 'database.db',
+                 database_pragmas: Optional[Dict[str, Any]] = None,
+                 database_write_behind: bool = False,
+                 database_pool_size: int = 8,
+                 hot_reload: bool = False,
+                 ws_ping_interval: Optional[float] = 25,
+                 ws_idle_timeout: Optional[float] = None,
+                 broker: Optional[Broker] = None,
+                 instrumentation: Optional[Instrumentation] = None,
+                 profile_route: Optional[str] = None):
         super().__init__(__name__)
 
-        self.__database = Database()
+        # route latencies, query and render timings and fan-out counts, exposed at /metrics;
+        # pass Instrumentation() to discard them or a subclass to send them elsewhere
+        self.__instrumentation = instrumentation if instrumentation is not None else Metrics()
+        # opt-in: sample the stacks of the threads serving this route rule, e.g. '/private-chat',
+        # and dump them at /metrics/profile
+        self.__profile_route = profile_route
+        self.__profiler = SamplingProfiler() if profile_route else None
+
+        # dead peers are detected by the websocket server's ping/pong keepalive;
+        # ws_idle_timeout additionally closes sockets that send nothing for that long
+        self.config['SOCK_SERVER_OPTIONS'] = {'ping_interval': ws_ping_interval}
+        self.__ws_idle_timeout = ws_idle_timeout
+
+        # with write-behind, concurrent sends share transactions; each request still waits for its commit
+        self.__database = Database(database_path,
+                                   pool_size=database_pool_size,
+                                   pragmas=database_pragmas,
+                                   write_behind=database_write_behind,
+                                   instrumentation=self.__instrumentation)
+        self.__templates = Templates(hot_reload=hot_reload, instrumentation=self.__instrumentation)
         self.__sock = Sock(self)
-        self.__websockets = {}
+        # a broker shares websocket delivery between workers, e.g. SqliteBroker() under gunicorn
+        self.__fanout = FanoutHub(broker=broker, instrumentation=self.__instrumentation)
+
+        self.before_request(self.__start_request)
+        self.after_request(self.__finish_request)
 
         self.__sock.route('/ws/<string:username>')(self.ws)
+        self.get('/metrics/fanout')(self.get_fanout_metrics)
+        self.get('/metrics/cache')(self.get_cache_metrics)
+        self.get('/metrics/writer')(self.get_writer_metrics)
+        self.get('/metrics')(self.get_metrics)
+        self.get('/metrics/profile')(self.get_profile)
 
         self.get('/')(self.register)
         self.get('/login')(self.login)
@@ -48,16 +111,21 @@ class WebApp(Flask):
 
         self.get('/private-chat')(self.get_private_chat)
         self.post('/private-chat')(self.post_private_chat)
+        self.get('/private-chat/older')(self.get_older_private_messages)
+        self.put('/private-chat/read')(self.put_private_chat_read)
 
         self.post('/private-message')(self.post_private_message)
 
         self.get('/group-chat')(self.get_group_chat)
         self.post('/group-chat')(self.post_group_chat)
+        self.get('/group-chat/older')(self.get_older_group_messages)
+        self.put('/group-chat/read')(self.put_group_chat_read)
         self.post('/view-group-chat')(self.post_view_group_chat)
 
         self.post('/group-message')(self.post_group_message)
 
         self.post('/main')(self.main)
+        self.get('/search')(self.get_search)
 
         self.post('/add-group-modal-reset')(self.post_add_group_modal_reset)
         self.post('/add-group-user-validation')(self.add_group_create_validation)
@@ -70,29 +138,133 @@ class WebApp(Flask):
         self.post('/register/username-validation')(self.post_register_username_validation)
         self.post('/register/display-name-validation')(self.post_register_display_name_validation)
 
-    def ws(self, ws: Server, username: str):
-        if username in self.__websockets:
-            self.__websockets[username].append(ws)
-        else:
-            self.__websockets[username] = [ws]
+    @property
+    def ws_idle_timeout(self) -> Optional[float]:
+        return self.__ws_idle_timeout
 
-        print(f'{username} connected a websocket. (count: {len(self.__websockets[username])})')
+    def open_websocket(self, username: str, ws: Server) -> Connection:
+        """Start delivering the user's updates to `ws`, anything with simple_websocket's `send` and `close`."""
+        connection = self.__fanout.register(username, ws)
 
-        while True:
-            try:
-                ws.receive(0)
-                sleep(1)
-            except ConnectionClosed:
-                if ws in self.__websockets[username]:
-                    self.__websockets[username].remove(ws)
+        logging.debug('%s connected a websocket. (count: %d)', username, self.__fanout.connection_count(username))
 
-                print(f'A {username} websocket is closed. (count: {len(self.__websockets[username])})')
+        return connection
 
-                break
+    def close_websocket(self, connection: Connection):
+        self.__fanout.unregister(connection)
+
+        logging.debug('A %s websocket is closed. (count: %d)', connection.username, self.__fanout.connection_count(connection.username))
+
+    def ws(self, ws: Server, username: str):
+        connection = self.open_websocket(username, ws)
+
+        try:
+            # blocks until the client sends something or the connection closes; no polling
+            while ws.receive(timeout=self.__ws_idle_timeout) is not None:
+                pass
+
+            ws.close(message='Idle timeout')
+        except ConnectionClosed:
+            pass
+        finally:
+            self.close_websocket(connection)
+
+    def get_fanout_metrics(self):
+        return self.__fanout.stats()
+
+    def get_cache_metrics(self):
+        return self.__database.cache_stats()
+
+    def get_writer_metrics(self):
+        return self.__database.writer_stats()
+
+    def get_metrics(self):
+        text = ''.join((
+            self.__instrumentation.expose(),
+            expose_stats('messaging_fanout', self.__fanout.stats()),
+            expose_stats('messaging_cache', self.__database.cache_stats(), label='cache'),
+            expose_stats('messaging_writer', self.__database.writer_stats()),
+        ))
+
+        return Response(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def get_profile(self):
+        """Collapsed stacks sampled from the profiled route so far; `?reset=1` starts over."""
+        if self.__profiler is None:
+            return Response('Profiling is off; create the WebApp with a profile_route.\n', status=404, mimetype='text/plain')
+
+        return Response(self.__profiler.collapsed(reset=request.args.get('reset') == '1'), mimetype='text/plain')
+
+    def __start_request(self):
+        g.request_start = perf_counter()
+        if self.__profiler is not None and request.url_rule is not None and request.url_rule.rule == self.__profile_route:
+            self.__profiler.track(threading.get_ident())
+            g.profiled = True
+
+    def __finish_request(self, response: Response) -> Response:
+        """Observe the request once the server closes the response, i.e. after the last chunk of a streamed one."""
+        start = g.pop('request_start', None)
+        if start is None:
+            return response
+
+        labels = {
+            'route': request.url_rule.rule if request.url_rule is not None else 'unmatched',
+            'method': request.method,
+            'status': str(response.status_code),
+        }
+        profiled_thread = threading.get_ident() if g.pop('profiled', False) else None
+
+        def finish():
+            self.__instrumentation.observe('http_request_duration_seconds', perf_counter() - start, **labels)
+            if profiled_thread is not None:
+                self.__profiler.untrack(profiled_thread)
+
+        response.call_on_close(finish)
+
+        return response
+
+    def __chat_messages(self,
+                        messages: Iterable[Union[PrivateMessage, GroupMessage]],
+                        current_user: str,
+                        older_url: str,
+                        has_older: bool) -> Iterator[str]:
+        """Render the bubbles of a page of messages one at a time, as they are fetched."""
+        t = self.__templates
+        for n, m in enumerate(messages):
+            # there is more history before this page; fetch it once the trigger scrolls into view
+            if n == 0 and has_older:
+                yield t.render('LOAD_OLDER',
+                    load_older_url=f'{older_url}&' + urlencode({'before': encode_cursor(m.message)})
+                )
+
+            if m.message.sender.handle != current_user:
+                yield t.render('CHAT_MESSAGE_RECEIVED',
+                               chat_message_received_sender=m.message.sender.name,
+                               chat_message_received_content=m.message.content,
+                               chat_message_received_time=m.message.created.strftime('%H:%M'))
+            else:
+                yield t.render('CHAT_MESSAGE_SENT',
+                               chat_message_sent_content=m.message.content,
+                               chat_message_sent_time=m.message.created.strftime('%H:%M'))
+
+    def __stream(self, *parts: Iterable[str]) -> Response:
+        """Send the parts to the client as they are produced instead of building the whole body first."""
+        return self.response_class(stream_with_context(chain(*parts)), mimetype='text/html')
+
+    def __unread_badge(self, count: int) -> str:
+        return self.__templates.render('CHAT_UNREAD_BADGE', chat_unread_count=count) if count else ''
+
+    def __clear_unread(self, current_user: str, chat_id: str) -> str:
+        """Render the cleared badge of a chat that was just read, and clear it on the user's other pages too."""
+        cleared = self.__templates.render('CHAT_UNREAD_UPDATE', chat_unread_id=f'{chat_id}-chat-unread')
+        if self.__fanout.is_connected(current_user):
+            self.__fanout.send(current_user, cleared)
+
+        return cleared
 
     @catch_exception
     def post_login_username_validation(self):
-        if self.__database.get_user_by_handle(request.form.get('username', '')) is not None:
+        if self.__database.user_exists(request.form.get('username', '')):
             validation = a('#user-validation.green-text')[
                 i('.material-icons.tiny')['check'],
                 'User exists.'
@@ -128,7 +300,7 @@ class WebApp(Flask):
 
         is_username_valid = False
         is_display_name_valid = bool(display)
-        if self.__database.get_user_by_handle(username) is not None:
+        if self.__database.user_exists(username):
             validation = a('#username-validation.red-text')[
                 i('.material-icons.tiny')['close'],
                 'User already exists.'
@@ -169,7 +341,7 @@ class WebApp(Flask):
         username = request.form.get('username', '')
         display = request.form.get('display-name', '')
 
-        is_username_valid = username and self.__database.get_user_by_handle(username) is None
+        is_username_valid = username and not self.__database.user_exists(username)
         is_display_name_valid = bool(display)
         if not is_display_name_valid:
             validation = a('#user-validation.red-text')[
@@ -271,7 +443,7 @@ class WebApp(Flask):
 
     @catch_exception
     def add_private_username_validation(self):
-        if self.__database.get_user_by_handle(request.form.get('username-input', '')) is not None:
+        if self.__database.user_exists(request.form.get('username-input', '')):
             validation = a('#add-private-modal-status.green-text')[
                 i('.material-icons.tiny')['check'],
                 'User exists.'
@@ -350,7 +522,7 @@ class WebApp(Flask):
     @catch_exception
     def add_group_create_validation(self):
         username = request.form.get('username-input', '')
-        if self.__database.get_user_by_handle(username) is not None:
+        if self.__database.user_exists(username):
             username_validation = a('#add-group-modal-username-status.green-text',
                                     hx_swap_oob='outerHTML')[
                                     i('.material-icons.tiny')['check'],
@@ -409,58 +581,96 @@ class WebApp(Flask):
 
     @catch_exception
     def main(self, username: str):
-        messages = self.__database.get_latest_group_messages_by_user(username) + self.__database.get_latest_private_messages_by_user(username)
-        sorted_messages = sorted(messages, key=lambda x: x.message.created, reverse=True)
-        main_user = self.__database.get_user_by_handle(username).name
-        all_chats = {g.name: None for g in self.__database.get_group_chats_by_username(username)}
-        for c in all_chats: print('c',c)
-        all_chats.update({
-            (((m.recipient.handle, m.recipient.name) if m.message.sender.handle == username else(m.message.sender.handle,  m.message.sender.name)) if isinstance(m, PrivateMessage) else m.group.name) : m for m in sorted_messages
-        })
-
-        print(all_chats)
-        
-        v = rel(imp('views'))
-
-        chats = tuple(
-            v.CHAT.set_vars(
-                chat_id=f'{n[0]}-chat',
-                chat_get_url=f'/private-chat?current-user={username}&target-user={n[0]}',
-                chat_title=n[1] if isinstance(m, PrivateMessage) else m.group.name,
-                chat_latest_text=f'You: {m.message.content}?' if m.message.sender.handle == username
-                else f'{m.message.sender.name}: {m.message.content}',
-                chat_latest_time=m.message.created.strftime('%H:%M')
-            ) if isinstance(n, tuple) else
-            v.CHAT.set_vars(
-                chat_id=f'{n}-chat',
-                chat_get_url=f'/group-chat?current-user={username}&group-name={n}',
-                chat_title=n,
-                chat_latest_text='<em>No message yet</em>' if m is None else f'You: {m.message.content}?' if m.message.sender.handle == username
-                else f'{m.message.sender.name}: {m.message.content}',
-                chat_latest_time='' if m is None else m.message.created.strftime('%H:%M')
-            ) for n, m in all_chats.items()
-        )
-
-        content = v.MAIN.set_vars(
+        user, summaries = self.__database.get_sidebar(username)
+        main_user = user.name
+
+        t = self.__templates
+
+        chats = []
+        for summary in summaries:
+            m = summary.latest_message
+            if isinstance(summary.chat, User):
+                chat_id = summary.chat.handle
+                chat_get_url = '/private-chat?' + urlencode({'current-user': username, 'target-user': summary.chat.handle})
+            else:
+                chat_id = summary.chat.name
+                chat_get_url = '/group-chat?' + urlencode({'current-user': username, 'group-name': summary.chat.name})
+
+            chats.append(t.render('CHAT',
+                chat_id=f'{chat_id}-chat',
+                chat_get_url=chat_get_url,
+                chat_title=summary.chat.name,
+                chat_latest_text=Markup('<em>No message yet</em>') if m is None else f'You: {m.content}?' if m.sender.handle == username
+                else f'{m.sender.name}: {m.content}',
+                chat_latest_time='' if m is None else m.created.strftime('%H:%M'),
+                chat_unread_id=f'{chat_id}-chat-unread',
+                chat_unread_badge=self.__unread_badge(summary.unread_count)
+            ))
+
+        content = t.render('MAIN',
             main_user_name=main_user,
             main_chats=chats,
             main_user_delete_url=f'/user/{username}',
             main_user_logout_url='/logout',
             add_private_modal_current_user=username,
             add_group_modal_user=username,
-        ).render(0)
+            main_search_url='/search?' + urlencode({'current-user': username}),
+        )
 
-        websocket = div('#websocket', hx_swap_oob='outerHTML', hx_ext='ws', ws_connect=f'/ws/{username}').render(0)
+        websocket = div('#websocket', hx_swap_oob='outerHTML', hx_ext='ws', ws_connect=escape(f'/ws/{username}')).render(0)
 
         return content + websocket
 
+    @catch_exception
+    def get_search(self):
+        t = self.__templates
+
+        current_user = request.args['current-user']
+        query = request.args.get('query', '')
+        after = request.args.get('after')
+        cursor = None
+        if after:
+            rank, message_id = after.split(':', 1)
+            cursor = (float(rank), int(message_id))
+
+        results = self.__database.search_messages(current_user, query, SEARCH_PAGE_SIZE, cursor)
+
+        items = []
+        for result in results:
+            if isinstance(result.chat, User):
+                url = '/private-chat?' + urlencode({'current-user': current_user, 'target-user': result.chat.handle})
+            else:
+                url = '/group-chat?' + urlencode({'current-user': current_user, 'group-name': result.chat.name})
+
+            # the snippet is cut from user text, so escape it before marking the matches
+            snippet = escape(result.snippet).replace(SNIPPET_MATCH_START, '<mark>').replace(SNIPPET_MATCH_END, '</mark>')
+            items.append(t.render('SEARCH_RESULT',
+                search_result_url=url,
+                search_result_title=result.chat.name,
+                search_result_time=result.message.created.strftime('%d/%m/%Y %H:%M'),
+                search_result_sender='You' if result.message.sender.handle == current_user else result.message.sender.name,
+                search_result_snippet=Markup(snippet)
+            ))
+
+        if len(results) == SEARCH_PAGE_SIZE:
+            last = results[-1]
+            items.append(t.render('SEARCH_MORE',
+                search_more_url='/search?' + urlencode({
+                    'current-user': current_user,
+                    'query': query,
+                    'after': f'{last.rank!r}:{last.message.id}'
+                })
+            ))
+        elif not results and not after and query.strip():
+            items.append(t.render('SEARCH_EMPTY'))
+
+        return ''.join(items)
+
     def register(self):
-        v = rel(imp('views'))
-        return v.ROOT.set_vars(main_content=v.REGISTER).render(0)
+        return self.__templates.page('register')
     
     def login(self):
-        v = rel(imp('views'))
-        return v.ROOT.set_vars(main_content=v.LOGIN).render(0)
+        return self.__templates.page('login')
     
     def post_login(self):
         username = request.form['username']
@@ -468,15 +678,31 @@ class WebApp(Flask):
         return self.main(username)
     
     def put_logout(self):
-        v = rel(imp('views'))
-        return v.LOGIN.render(0)
+        return self.__templates.page('login_form')
     
     def post_user(self):
-        v = rel(imp('views'))
-        user = self.__database.create_user(User(
-            request.form['username'],
-            request.form['display-name']
-        ))
+        try:
+            user = self.__database.create_user(User(
+                request.form['username'],
+                request.form['display-name']
+            ))
+        except ValueError:
+            # the handle was taken after it was validated; keep the form and say so
+            validation = p('#username-validation', hx_swap_oob='innerHTML')[
+                a('.red-text')[
+                    i('.material-icons.tiny')['close'],
+                    'User already exists.'
+                ]
+            ].render()
+            register = a("#register-button.waves-effect.waves-light.btn.disabled",
+                        hx_post='/user',
+                        hx_target='#main-content',
+                        hx_swap_oob='outerHTML')[
+                'Register',
+                i('.material-icons.right')['send']
+            ].render()
+
+            return Response(validation + register, headers={'HX-Reswap': 'none'})
 
         return self.main(user.handle)
 
@@ -490,44 +716,36 @@ class WebApp(Flask):
     
     @catch_exception
     def delete_user(self, username: str):
-        v = rel(imp('views'))
-
         self.__database.delete_user(username)
 
-        return v.LOGIN.render(0)
+        return self.__templates.page('login_form')
     
     @catch_exception
     def post_private_chat(self):
-        v = rel(imp('views'))
+        t = self.__templates
 
         current_user = request.form['current-user']
         target_user = request.form['username-input']
 
-        messages = self.__database.get_private_messages(current_user, target_user) + \
-        self.__database.get_private_messages(target_user, current_user)
-        sorted_messages = sorted(messages, key=lambda x: x.message.created)
-
-        active_chat = v.ACTIVE_CHAT(hx_swap_oob='outerHTML').set_vars(
-            active_chat_messages=[
-                v.CHAT_MESSAGE_RECEIVED.set_vars(chat_message_received_sender=m.message.sender.name,
-                                                 chat_message_received_content=m.message.content,
-                                                 chat_message_received_time=m.message.created.strftime('%H:%M'))
-                if m.recipient.handle == current_user
-                else v.CHAT_MESSAGE_SENT.set_vars(chat_message_sent_content=m.message.content,
-                                                  chat_message_sent_time=m.message.created.strftime('%H:%M'))
-                for m in sorted_messages
-            ],
+        has_older = self.__database.has_more_private_messages(current_user, target_user, PAGE_SIZE)
+        messages = self.__database.iter_private_messages(current_user, target_user, PAGE_SIZE)
+        self.__database.mark_private_chat_read(current_user, target_user)
+
+        active_chat = t.render_iter('ACTIVE_CHAT_OOB',
+            active_chat_messages=self.__chat_messages(
+                messages, current_user, '/private-chat/older?' + urlencode({'current-user': current_user, 'target-user': target_user}), has_older
+            ),
             active_chat_current_user=current_user,
             active_chat_target_user=target_user,
             active_chat_title=target_user,
             active_chat_send_url='/private-message',
-        ).render(0)
+        )
 
-        return active_chat
+        return self.__stream(active_chat, [self.__clear_unread(current_user, target_user)])
     
     @catch_exception
     def post_private_message(self):
-        v = rel(imp('views'))
+        t = self.__templates
 
         current_user = request.form['current-user']
         target_user = request.form['target-user']
@@ -536,180 +754,222 @@ class WebApp(Flask):
         current_user_obj = self.__database.get_user_by_handle(current_user)
         target_user_obj = self.__database.get_user_by_handle(target_user)
 
-        self.__database.create_private_message(
+        private_message = self.__database.create_private_message(
             Message(content=message_content,
                     sender=current_user_obj,
                     created=datetime.now(),
                     modified=None),
-            self.__database.get_user_by_handle(target_user)
+            target_user_obj
+        )
+        # the stored message carries the display names as of the write
+        latest_message = private_message.message
+        current_user_obj, target_user_obj = latest_message.sender, private_message.recipient
+
+        # append only the new bubble; the rest of the chat is already on the sender's page
+        sent_bubble = t.render('CHAT_MESSAGE_APPEND',
+            chat_message_append_target=f'beforeend:[chat-target={target_user}]',
+            chat_message_append_bubble=t.render('CHAT_MESSAGE_SENT',
+                chat_message_sent_content=latest_message.content,
+                chat_message_sent_time=latest_message.created.strftime('%H:%M')
+            )
         )
 
-        messages = self.__database.get_private_messages(current_user, target_user)
-        sorted_messages = sorted(messages, key=lambda x: x.message.created)
-
-        active_chat = v.ACTIVE_CHAT.set_vars(
-            active_chat_messages=[
-                v.CHAT_MESSAGE_RECEIVED.set_vars(chat_message_received_sender=m.message.sender.name,
-                                                 chat_message_received_content=m.message.content,
-                                                 chat_message_received_time=m.message.created.strftime('%H:%M'))
-                if m.recipient.handle == current_user
-                else v.CHAT_MESSAGE_SENT.set_vars(chat_message_sent_content=m.message.content,
-                                                  chat_message_sent_time=m.message.created.strftime('%H:%M'))
-                for m in sorted_messages
-            ],
-            active_chat_current_user=current_user,
-            active_chat_target_user=target_user,
-            active_chat_title=target_user,
-            active_chat_send_url='/private-message',
-        ).render(0)
-
-        latest_message = sorted_messages[-1].message
-
-        user_updated_chat = v.CHAT.set_vars(
+        user_updated_chat = t.render('CHAT_UPDATE',
             chat_id=f'{target_user}-chat',
             chat_title=target_user_obj.name,
             chat_latest_text=f'You: {latest_message.content}',
-            chat_latest_time=latest_message.created.strftime('%H:%M')
-        )(hx_swap_oob='innerHTML').render(0)
+            chat_latest_time=latest_message.created.strftime('%H:%M'),
+            chat_unread_id=f'{target_user}-chat-unread'
+        )
 
-        if len(self.__websockets.get(target_user, [])) > 0:
-            print(f'{target_user} has {len(self.__websockets.get(target_user, []))} websockets.')
-            target_updated_chat = v.CHAT.set_vars(
+        if self.__fanout.is_connected(target_user):
+            logging.debug('%s has %d local websockets.', target_user, self.__fanout.connection_count(target_user))
+            target_updated_chat = t.render('CHAT_UPDATE',
                 chat_id=f'{current_user}-chat',
-                chat_get_url=f'/private-chat?current-user={current_user}&target-user={target_user}',
+                chat_get_url='/private-chat?' + urlencode({'current-user': current_user, 'target-user': target_user}),
                 chat_title=current_user_obj.name,
                 chat_latest_text=f'{current_user_obj.name}: {latest_message.content}',
-                chat_latest_time=latest_message.created.strftime('%H:%M')
-            )(hx_swap_oob='innerHTML').render(0)
+                chat_latest_time=latest_message.created.strftime('%H:%M'),
+                chat_unread_id=f'{current_user}-chat-unread',
+                chat_unread_badge=self.__unread_badge(self.__database.get_private_unread_count(target_user, current_user))
+            )
 
-            for ws in self.__websockets[target_user]:
-                message_bubble = div('.row', style='margin: 0')[
-                    v.CHAT_MESSAGE_RECEIVED.set_vars(
+            message_bubble = t.render('CHAT_MESSAGE_APPEND',
+                chat_message_append_target=f'beforeend:[chat-target={current_user}]',
+                chat_message_append_bubble=[
+                    t.render('CHAT_MESSAGE_RECEIVED',
                         chat_message_received_sender=latest_message.sender.name,
                         chat_message_received_content=latest_message.content,
                         chat_message_received_time=latest_message.created.strftime('%H:%M')
+                    ),
+                    t.render('READ_MARKER',
+                        read_marker_url='/private-chat/read?' + urlencode({'current-user': target_user, 'target-user': current_user})
                     )
-                ](hx_swap_oob=f'beforeend:[chat-target={current_user}]').render(0)
+                ]
+            )
 
-                ws.send(target_updated_chat + message_bubble)
+            self.__fanout.send(target_user, target_updated_chat + message_bubble)
 
-        return active_chat + user_updated_chat
+        return sent_bubble + user_updated_chat
     
     @catch_exception
     def get_private_chat(self):
-        v = rel(imp('views'))
+        t = self.__templates
 
         current_user = request.args['current-user']
         target_user = request.args['target-user']
 
-        messages = self.__database.get_private_messages(current_user, target_user)
-        sorted_messages = sorted(messages, key=lambda x: x.message.created)
-
-        return v.ACTIVE_CHAT.set_vars(
-            active_chat_messages=[
-                v.CHAT_MESSAGE_RECEIVED.set_vars(chat_message_received_sender=m.message.sender.name,
-                                                 chat_message_received_content=m.message.content,
-                                                 chat_message_received_time=m.message.created.strftime('%H:%M'))
-                if m.recipient.handle == current_user
-                else v.CHAT_MESSAGE_SENT.set_vars(chat_message_sent_content=m.message.content,
-                                                  chat_message_sent_time=m.message.created.strftime('%H:%M'))
-                for m in sorted_messages
-            ],
+        has_older = self.__database.has_more_private_messages(current_user, target_user, PAGE_SIZE)
+        messages = self.__database.iter_private_messages(current_user, target_user, PAGE_SIZE)
+        self.__database.mark_private_chat_read(current_user, target_user)
+
+        active_chat = t.render_iter('ACTIVE_CHAT',
+            active_chat_messages=self.__chat_messages(
+                messages, current_user, '/private-chat/older?' + urlencode({'current-user': current_user, 'target-user': target_user}), has_older
+            ),
             active_chat_current_user=current_user,
             active_chat_target_user=target_user,
             active_chat_title=target_user,
             active_chat_send_url='/private-message',
-        ).render(0)
+        )
+
+        return self.__stream(active_chat, [self.__clear_unread(current_user, target_user)])
     
+    @catch_exception
+    def get_older_private_messages(self):
+        current_user = request.args['current-user']
+        target_user = request.args['target-user']
+
+        before = decode_cursor(request.args['before'])
+        has_older = self.__database.has_more_private_messages(current_user, target_user, PAGE_SIZE, before)
+        messages = self.__database.iter_private_messages(current_user, target_user, PAGE_SIZE, before)
+
+        return self.__stream(self.__chat_messages(
+            messages, current_user, '/private-chat/older?' + urlencode({'current-user': current_user, 'target-user': target_user}), has_older
+        ))
+
+    @catch_exception
+    def put_private_chat_read(self):
+        current_user = request.args['current-user']
+        target_user = request.args['target-user']
+
+        self.__database.mark_private_chat_read(current_user, target_user)
+
+        return self.__clear_unread(current_user, target_user)
+
     @catch_exception
     def get_group_chat(self):
-        v = rel(imp('views'))
+        t = self.__templates
 
         current_user = request.args['current-user']
         group_name = request.args['group-name']
 
-        messages = self.__database.get_group_messages(group_name)
-
-        return v.ACTIVE_CHAT.set_vars(
-            active_chat_messages=[
-                v.CHAT_MESSAGE_RECEIVED.set_vars(chat_message_received_sender=m.message.sender.name,
-                                                 chat_message_received_content=m.message.content,
-                                                 chat_message_received_time=m.message.created.strftime('%H:%M'))
-                if m.message.sender.handle != current_user
-                else v.CHAT_MESSAGE_SENT.set_vars(chat_message_sent_content=m.message.content,
-                                                  chat_message_sent_time=m.message.created.strftime('%H:%M'))
-                for m in messages
-            ],
+        has_older = self.__database.has_more_group_messages(group_name, PAGE_SIZE)
+        messages = self.__database.iter_group_messages(group_name, PAGE_SIZE)
+        self.__database.mark_group_chat_read(current_user, group_name)
+
+        active_chat = t.render_iter('ACTIVE_CHAT',
+            active_chat_messages=self.__chat_messages(
+                messages, current_user, '/group-chat/older?' + urlencode({'current-user': current_user, 'group-name': group_name}), has_older
+            ),
             active_chat_current_user=current_user,
             active_chat_target_user=group_name,
             active_chat_title=group_name,
             active_chat_send_url='/group-message',
-        ).render(0)
+        )
+
+        return self.__stream(active_chat, [self.__clear_unread(current_user, group_name)])
     
+    @catch_exception
+    def get_older_group_messages(self):
+        current_user = request.args['current-user']
+        group_name = request.args['group-name']
+
+        before = decode_cursor(request.args['before'])
+        has_older = self.__database.has_more_group_messages(group_name, PAGE_SIZE, before)
+        messages = self.__database.iter_group_messages(group_name, PAGE_SIZE, before)
+
+        return self.__stream(self.__chat_messages(
+            messages, current_user, '/group-chat/older?' + urlencode({'current-user': current_user, 'group-name': group_name}), has_older
+        ))
+
+    @catch_exception
+    def put_group_chat_read(self):
+        current_user = request.args['current-user']
+        group_name = request.args['group-name']
+
+        self.__database.mark_group_chat_read(current_user, group_name)
+
+        return self.__clear_unread(current_user, group_name)
+
     @catch_exception
     def post_group_chat(self):
-        v = rel(imp('views'))
+        t = self.__templates
 
         member_usernames = request.form.getlist('member')
         group_name = request.form['group-name-input']
         current_user = request.form['current-user']
 
-        self.__database.create_group_chat(group_name, member_usernames)
+        try:
+            self.__database.create_group_chat(group_name, member_usernames)
+        except ValueError:
+            # e.g. a member was deleted after being added in the modal; leave the open chat as it is
+            unknown = [member for member in dict.fromkeys(member_usernames) if not self.__database.user_exists(member)]
+            status = a('#add-group-modal-username-status.red-text', hx_swap_oob='outerHTML')[
+                i('.material-icons.tiny')['close'],
+                escape(f"User not found: {', '.join(unknown)}.")
+            ].render()
 
-        target_updated_chat = div(hx_swap_oob='beforeend:#chats')[
-            v.CHAT.set_vars(
-                chat_id=f'{group_name}-chat',
-                chat_get_url=f'/group-chat?current-user={current_user}&group-name={group_name}',
-                chat_title=group_name,
-                chat_latest_text='<em>No message yet</em>',
-                chat_latest_time=''
-            )
-        ].render(0)
+            return Response(status, headers={'HX-Reswap': 'none'})
+
+        target_updated_chat = t.render('CHAT_APPEND',
+            chat_id=f'{group_name}-chat',
+            chat_get_url='/group-chat?' + urlencode({'current-user': current_user, 'group-name': group_name}),
+            chat_title=group_name,
+            chat_latest_text=Markup('<em>No message yet</em>'),
+            chat_latest_time='',
+            chat_unread_id=f'{group_name}-chat-unread'
+        )
         
         for member in member_usernames:
-            if member != current_user and len(self.__websockets.get(member, [])) > 0:
-                print(f'{member} has {len(self.__websockets.get(member, []))} websockets.')
-                for ws in self.__websockets[member]:
-                    ws.send(target_updated_chat)
+            if member != current_user and self.__fanout.is_connected(member):
+                logging.debug('%s has %d local websockets.', member, self.__fanout.connection_count(member))
+                self.__fanout.send(member, target_updated_chat)
 
-        return target_updated_chat + v.ACTIVE_CHAT.set_vars(
+        return target_updated_chat + t.render('ACTIVE_CHAT',
             active_chat_messages='',
             active_chat_current_user=current_user,
             active_chat_target_user=group_name,
             active_chat_title=group_name,
             active_chat_send_url='/group-message',
-        ).render(0)
+        )
 
     @catch_exception
     def post_view_group_chat(self):
-        v = rel(imp('views'))
+        t = self.__templates
 
         current_user = request.args['current-user']
         group_name = request.args['group-name']
 
-        messages = self.__database.get_group_messages(group_name)
-
-        active_chat = v.ACTIVE_CHAT(hx_swap_oob='outerHTML').set_vars(
-            active_chat_messages=[
-                v.CHAT_MESSAGE_RECEIVED.set_vars(chat_message_received_sender=m.message.sender.name,
-                                                 chat_message_received_content=m.message.content,
-                                                 chat_message_received_time=m.message.created.strftime('%H:%M'))
-                if m.recipient.handle == current_user
-                else v.CHAT_MESSAGE_SENT.set_vars(chat_message_sent_content=m.message.content,
-                                                  chat_message_sent_time=m.message.created.strftime('%H:%M'))
-                for m in messages
-            ],
+        has_older = self.__database.has_more_group_messages(group_name, PAGE_SIZE)
+        messages = self.__database.iter_group_messages(group_name, PAGE_SIZE)
+        self.__database.mark_group_chat_read(current_user, group_name)
+
+        active_chat = t.render_iter('ACTIVE_CHAT_OOB',
+            active_chat_messages=self.__chat_messages(
+                messages, current_user, '/group-chat/older?' + urlencode({'current-user': current_user, 'group-name': group_name}), has_older
+            ),
             active_chat_current_user=current_user,
             active_chat_target_user=group_name,
             active_chat_title=group_name,
             active_chat_send_url='/group-message',
-        ).render(0)
+        )
 
-        return active_chat
+        return self.__stream(active_chat, [self.__clear_unread(current_user, group_name)])
     
     @catch_exception
     def post_group_message(self):
-        v = rel(imp('views'))
+        t = self.__templates
 
         current_user = request.form['current-user']
         group_name = request.form['target-user']
@@ -717,64 +977,64 @@ class WebApp(Flask):
 
         current_user_obj = self.__database.get_user_by_handle(current_user)
 
-        self.__database.create_group_message(
+        group_message, unread_counts = self.__database.send_group_message(
             Message(content=message_content,
                     sender=current_user_obj,
                     created=datetime.now(),
                     modified=None),
             GroupChat(name=group_name)
         )
+        latest_message = group_message.message
+        current_user_obj = latest_message.sender
+
+        # append only the new bubble; the rest of the chat is already on the sender's page
+        sent_bubble = t.render('CHAT_MESSAGE_APPEND',
+            chat_message_append_target=f'beforeend:[chat-target={group_name}]',
+            chat_message_append_bubble=t.render('CHAT_MESSAGE_SENT',
+                chat_message_sent_content=latest_message.content,
+                chat_message_sent_time=latest_message.created.strftime('%H:%M')
+            )
+        )
 
-        messages = self.__database.get_group_messages(group_name)
-
-        active_chat = v.ACTIVE_CHAT.set_vars(
-            active_chat_messages=[
-                v.CHAT_MESSAGE_RECEIVED.set_vars(chat_message_received_sender=m.sender.name,
-                                                 chat_message_received_content=m.content,
-                                                 chat_message_received_time=m.created.strftime('%H:%M'))
-                if m.sender.handle != current_user
-                else v.CHAT_MESSAGE_SENT.set_vars(chat_message_sent_content=m.content,
-                                                  chat_message_sent_time=m.created.strftime('%H:%M'))
-                for m in (gm.message for gm in messages)
-            ],
-            active_chat_current_user=current_user,
-            active_chat_target_user=group_name,
-            active_chat_title=group_name,
-            active_chat_send_url='/group-message',
-        ).render(0)
-
-        latest_message = messages[-1].message
-
-        user_updated_chat = v.CHAT.set_vars(
+        user_updated_chat = t.render('CHAT_UPDATE',
             chat_id=f'{group_name}-chat',
             chat_title=group_name,
             chat_latest_text=f'You: {latest_message.content}',
-            chat_latest_time=latest_message.created.strftime('%H:%M')
-        )(hx_swap_oob='innerHTML').render(0)
+            chat_latest_time=latest_message.created.strftime('%H:%M'),
+            chat_unread_id=f'{group_name}-chat-unread'
+        )
 
+        received_bubble = t.render('CHAT_MESSAGE_RECEIVED',
+            chat_message_received_sender=latest_message.sender.name,
+            chat_message_received_content=latest_message.content,
+            chat_message_received_time=latest_message.created.strftime('%H:%M')
+        )
 
-        for user in self.__database.get_users_in_group_chat(GroupChat(name=group_name)):
-            if len(self.__websockets.get(user.handle, [])) > 0:
-                print(f'{user.handle} has {len(self.__websockets.get(user.handle, []))} websockets.')
-                target_updated_chat = v.CHAT.set_vars(
+        for member, unread_count in unread_counts.items():
+            if member != current_user and self.__fanout.is_connected(member):
+                logging.debug('%s has %d local websockets.', member, self.__fanout.connection_count(member))
+                target_updated_chat = t.render('CHAT_UPDATE',
                     chat_id=f'{group_name}-chat',
                     chat_title=group_name,
                     chat_latest_text=f'{current_user_obj.name}: {latest_message.content}',
-                    chat_latest_time=latest_message.created.strftime('%H:%M')
-                )(hx_swap_oob='innerHTML').render(0)
-
-                for ws in self.__websockets[user.handle]:
-                    message_bubble = div('.row', style='margin: 0')[
-                        v.CHAT_MESSAGE_RECEIVED.set_vars(
-                            chat_message_received_sender=latest_message.sender.name,
-                            chat_message_received_content=latest_message.content,
-                            chat_message_received_time=latest_message.created.strftime('%H:%M')
+                    chat_latest_time=latest_message.created.strftime('%H:%M'),
+                    chat_unread_id=f'{group_name}-chat-unread',
+                    chat_unread_badge=self.__unread_badge(unread_count)
+                )
+
+                message_bubble = t.render('CHAT_MESSAGE_APPEND',
+                    chat_message_append_target=f'beforeend:[chat-target={group_name}]',
+                    chat_message_append_bubble=[
+                        received_bubble,
+                        t.render('READ_MARKER',
+                            read_marker_url='/group-chat/read?' + urlencode({'current-user': member, 'group-name': group_name})
                         )
-                    ](hx_swap_oob=f'beforeend:[chat-target={group_name}]').render(0)
+                    ]
+                )
 
-                    ws.send(target_updated_chat + message_bubble)
+                self.__fanout.send(member, target_updated_chat + message_bubble)
 
-        return active_chat + user_updated_chat
+        return sent_bubble + user_updated_chat
 
 if __name__ == '__main__':
-    WebApp().run()
\ No newline at end of file
+    WebApp(hot_reload=True).run()
\ No newline at end of file
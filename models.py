@@ -1,35 +1,50 @@
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Union
 
-@dataclass
+# users and groups are shared between the results of a query (and cached), so they are immutable
+@dataclass(frozen=True, slots=True)
 class User:
     handle: str
     name: str
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class GroupChat:
     name: str
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     content: str
     sender: User
     created: datetime
     modified: Optional[datetime]
+    id: Optional[int] = None
 
-@dataclass
+@dataclass(slots=True)
 class PrivateMessage:
     message: Message
     recipient: User
 
-@dataclass
+@dataclass(slots=True)
 class GroupMessage:
     message: Message
     group: GroupChat
 
-@dataclass
+@dataclass(slots=True)
 class GroupMembership:
     group: GroupChat
     user: User
     is_admin: bool
+
+@dataclass(slots=True)
+class ChatSummary:
+    chat: Union[User, GroupChat]
+    latest_message: Optional[Message]
+    unread_count: int = 0
+
+@dataclass(slots=True)
+class SearchResult:
+    message: Message
+    chat: Union[User, GroupChat]    # the other user of a private chat, or the group
+    snippet: str
+    rank: float                     # bm25, lower is better
@@ -0,0 +1,224 @@
+from html import escape
+from importlib import import_module, reload
+import os
+import re
+import threading
+import time
+from types import ModuleType
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from chope import Element
+from chope.css import Css
+from chope.variable import Var
+
+from instrumentation import Instrumentation
+
+
+# a rendered slot marker is either a quoted attribute value (="\0name\0") or bare content (\0name\0)
+_SLOT = re.compile('="\0([^\0]+)\0"|\0([^\0]+)\0')
+
+# approximate number of characters `render_iter` buffers before yielding a chunk
+STREAM_CHUNK_SIZE = 8192
+
+
+class Markup(str):
+    """Already rendered HTML, or text already escaped, inserted into a slot as is."""
+
+
+def _render_value(value: Any, quote: bool = False) -> str:
+    """Render a slot value the way chope renders a `Var` value with `render(0)`, escaping text.
+
+    A plain string is escaped first, so it renders like chope given the escaped string. Markup
+    is inserted as is into content; chope quotes any string in an attribute, Markup included.
+    """
+    if isinstance(value, Markup) and not quote:
+        return value
+    elif isinstance(value, (Element, Css)):
+        return value.render(0)
+    elif isinstance(value, Var):
+        return _render_value(value.value, quote)
+    elif isinstance(value, str):
+        value = value if isinstance(value, Markup) else escape(value)
+        return f"'{value}'" if '"' in value else f'"{value}"' if quote else value
+    elif isinstance(value, Iterable):
+        return ''.join(_render_value(v) for v in value)
+    else:
+        return str(value)
+
+
+def _trusted(value: Any) -> Any:
+    """Text written into the views themselves, e.g. a default, is HTML rather than user text."""
+    return Markup(value) if isinstance(value, str) else value
+
+
+def _var_defaults(component: Any, defaults: Dict[str, Any]):
+    if isinstance(component, Var):
+        defaults.setdefault(component.name, _trusted(component._value))
+        _var_defaults(component._value, defaults)
+    elif isinstance(component, Element):
+        for c in (component._id, component._classes, *component._attributes.values(), *component._components):
+            _var_defaults(c, defaults)
+
+
+class CompiledTemplate:
+    """A chope component flattened into literal chunks and `Var` slots.
+
+    `render(**values)` produces the same string as `component.set_vars(**values).render(0)`
+    with every plain string value escaped, but only joins strings instead of copying and
+    walking the element tree. Pass `Markup` for values that are HTML already. A slot name used
+    more than once takes the default of its first occurrence.
+    """
+
+    def __init__(self, component: Element) -> None:
+        defaults = {}
+        _var_defaults(component, defaults)
+
+        # render once with a marker in every slot, then cut the output at the markers
+        marked = component.set_vars({name: f'\0{name}\0' for name in defaults}).render(0)
+
+        self.__parts: List[Union[str, Tuple[str, bool]]] = []
+        position = 0
+        for match in _SLOT.finditer(marked):
+            attribute, content = match.groups()
+            if attribute:
+                self.__parts.append(marked[position:match.start()] + '=')
+                self.__parts.append((attribute, True))
+            else:
+                self.__parts.append(marked[position:match.start()])
+                self.__parts.append((content, False))
+            position = match.end()
+        self.__parts.append(marked[position:])
+
+        self.__defaults = {
+            name: CompiledTemplate(default) if isinstance(default, Element) else default
+            for name, default in defaults.items()
+        }
+
+    def __value(self, name: str, values: Dict[str, Any]) -> Any:
+        value = values[name] if name in values else self.__defaults.get(name)
+        # chope fills the values into a default Var too
+        while isinstance(value, Var):
+            name = value.name
+            value = values[name] if name in values else _trusted(value._value)
+
+        return Markup(f'[{name} is not set]') if value is None else value
+
+    def render(self, **values) -> Markup:
+        chunks = []
+        for part in self.__parts:
+            if isinstance(part, str):
+                chunks.append(part)
+                continue
+
+            name, quote = part
+            value = self.__value(name, values)
+            if isinstance(value, CompiledTemplate):
+                # chope fills the values into a default element too
+                chunks.append(value.render(**values))
+            else:
+                chunks.append(_render_value(value, quote))
+
+        return Markup(''.join(chunks))
+
+    def render_iter(self, **values) -> Iterator[str]:
+        """Yield the output of `render` in chunks of about STREAM_CHUNK_SIZE characters.
+
+        A slot value that is an iterator, e.g. a generator of rendered rows, is consumed lazily
+        once everything before the slot has been yielded.
+        """
+        chunks = []
+        size = 0
+        for part in self.__parts:
+            if isinstance(part, str):
+                items = (part,)
+            else:
+                name, quote = part
+                value = self.__value(name, values)
+                if isinstance(value, CompiledTemplate):
+                    items = (value.render(**values),)
+                elif isinstance(value, Iterator):
+                    # send what precedes the slot before waiting on the iterator
+                    if chunks:
+                        yield ''.join(chunks)
+                        chunks, size = [], 0
+                    items = (_render_value(v) for v in value)
+                else:
+                    items = (_render_value(value, quote),)
+
+            for item in items:
+                chunks.append(item)
+                size += len(item)
+                if size >= STREAM_CHUNK_SIZE:
+                    yield ''.join(chunks)
+                    chunks, size = [], 0
+
+        if chunks:
+            yield ''.join(chunks)
+
+
+class Templates:
+    """Loads the `views` module once and keeps the pages that never change pre-rendered.
+
+    With `hot_reload` enabled, the module is reloaded whenever its file's mtime changes,
+    which is meant for development only.
+    """
+
+    def __init__(self,
+                 module_name: str = 'views',
+                 hot_reload: bool = False,
+                 instrumentation: Optional[Instrumentation] = None) -> None:
+        self.__hot_reload = hot_reload
+        self.__instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.__lock = threading.Lock()
+        self.__load(import_module(module_name))
+
+    def __load(self, module: ModuleType):
+        self.__module = module
+        self.__mtime = os.path.getmtime(module.__file__)
+
+        self.__pages = {
+            'register': module.ROOT.set_vars(main_content=module.REGISTER).render(0),
+            'login': module.ROOT.set_vars(main_content=module.LOGIN).render(0),
+            'login_form': module.LOGIN.render(0),
+        }
+        self.__compiled = {
+            name: CompiledTemplate(component)
+            for name, component in vars(module).items()
+            if name.isupper() and isinstance(component, Element)
+        }
+
+    def __reload_if_changed(self):
+        try:
+            mtime = os.path.getmtime(self.__module.__file__)
+        except OSError:
+            return
+
+        if mtime != self.__mtime:
+            with self.__lock:
+                if mtime != self.__mtime:
+                    self.__load(reload(self.__module))
+
+    def page(self, name: str) -> str:
+        """Return one of the fully static pages rendered at load time."""
+        if self.__hot_reload:
+            self.__reload_if_changed()
+
+        return self.__pages[name]
+
+    def render(self, name: str, **values) -> Markup:
+        """Render the `views` component `name` through its compiled template."""
+        if self.__hot_reload:
+            self.__reload_if_changed()
+
+        start = time.perf_counter()
+        rendered = self.__compiled[name].render(**values)
+        self.__instrumentation.observe('template_render_duration_seconds', time.perf_counter() - start, template=name)
+
+        return rendered
+
+    def render_iter(self, name: str, **values) -> Iterator[str]:
+        """Stream the `views` component `name` through its compiled template."""
+        if self.__hot_reload:
+            self.__reload_if_changed()
+
+        return self.__instrumentation.timed('template_render_duration_seconds', self.__compiled[name].render_iter(**values), template=name)
@@ -0,0 +1,101 @@
+import socket
+import threading
+import time
+
+import pytest
+from simple_websocket import ConnectionClosed
+
+from fanout import FanoutHub
+
+
+class HealthySocket:
+    def __init__(self) -> None:
+        self.frames = []
+        self.received = threading.Event()
+
+    def send(self, frame: str):
+        self.frames.append(frame)
+        self.received.set()
+
+    def close(self, reason=None, message=None):
+        pass
+
+
+class StalledSocket:
+    """A websocket whose client stopped reading, like the ASGI one: sends block until `abort`."""
+
+    def __init__(self) -> None:
+        self.aborted = threading.Event()
+
+    def send(self, frame: str):
+        self.aborted.wait()
+        raise ConnectionClosed()
+
+    def close(self, reason=None, message=None):
+        self.send('')
+
+    def abort(self):
+        self.aborted.set()
+
+
+class BlockedSocket:
+    """A websocket over a real socket whose peer never reads, so sends block in the kernel."""
+
+    def __init__(self) -> None:
+        self.sock, self.peer = socket.socketpair()
+
+    def send(self, frame: str):
+        self.sock.sendall(frame.encode())
+
+    def close(self, reason=None, message=None):
+        self.sock.close()
+
+
+# large enough to fill the socket buffers
+FRAME = 'x' * (8 * 1024 * 1024)
+
+
+@pytest.mark.parametrize('stalled_socket', [StalledSocket, BlockedSocket])
+def test_stalled_sockets_do_not_hold_up_others(stalled_socket):
+    hub = FanoutHub(writers=4, send_timeout=0.5)
+    try:
+        stalled = [hub.register(f'stalled{n}', stalled_socket()) for n in range(4)]
+        for connection in stalled:
+            hub.send(connection.username, FRAME)
+        # every writer is now blocked on a stalled socket
+        time.sleep(0.1)
+
+        healthy = HealthySocket()
+        hub.register('healthy', healthy)
+        hub.send('healthy', 'hello')
+
+        # delivered once the first stalled send misses its deadline, not after all of them
+        assert healthy.received.wait(5)
+        assert healthy.frames == ['hello']
+
+        deadline = time.monotonic() + 5
+        while hub.stats()['send_timeouts'] < 4 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        stats = hub.stats()
+        assert stats['send_timeouts'] == 4
+        assert stats['connections'] == 1
+        assert all(not hub.is_connected(connection.username) for connection in stalled)
+    finally:
+        hub.close()
+
+
+def test_fast_sockets_are_not_aborted():
+    hub = FanoutHub(writers=2, send_timeout=0.2)
+    try:
+        sockets = [HealthySocket() for _ in range(8)]
+        for n, ws in enumerate(sockets):
+            hub.register(f'user{n}', ws)
+        for n in range(8):
+            hub.send(f'user{n}', 'frame')
+
+        assert all(ws.received.wait(5) for ws in sockets)
+        time.sleep(0.3)
+        assert hub.stats()['send_timeouts'] == 0
+        assert hub.stats()['connections'] == 8
+    finally:
+        hub.close()
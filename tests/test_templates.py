@@ -0,0 +1,127 @@
+from html import escape
+from typing import Tuple
+
+import pytest
+from chope import Element, b, div, span
+from chope.variable import Var
+
+import views
+from templates import CompiledTemplate, Markup
+
+
+COMPONENTS = {
+    name: component
+    for name, component in vars(views).items()
+    if name.isupper() and isinstance(component, Element)
+}
+
+# slot values as CompiledTemplate gets them; chope gets text escaped, see `escaped`
+VALUES = {
+    'plain': lambda name: f'{name} value',
+    'double quotes': lambda name: f'say "{name}"',
+    'single quote': lambda name: f"{name}'s",
+    'both quotes': lambda name: f'''"{name}" isn't''',
+    'html text': lambda name: f'<script>alert("{name}")</script> & more',
+    'escaped text': lambda name: Markup(escape(f'<script>alert("{name}")</script> & more')),
+    'number': lambda name: 42,
+}
+
+
+def slots(component, content: set = None, attributes: set = None, attribute: bool = False) -> Tuple[set, set]:
+    """Return the names of the component's content slots and of its attribute slots."""
+    content = set() if content is None else content
+    attributes = set() if attributes is None else attributes
+    if isinstance(component, Var):
+        (attributes if attribute else content).add(component.name)
+        slots(component._value, content, attributes, attribute)
+    elif isinstance(component, Element):
+        for c in (component._id, component._classes, *component._attributes.values()):
+            slots(c, content, attributes, True)
+        for c in component._components:
+            slots(c, content, attributes, False)
+
+    return content, attributes
+
+
+BADGE = views.CHAT_UNREAD_BADGE.set_vars(chat_unread_count=3)
+BUBBLE = views.CHAT_MESSAGE_SENT.set_vars(chat_message_sent_content='hi', chat_message_sent_time='12:00')
+
+
+def escaped(value):
+    """Escape text the way CompiledTemplate does, since chope inserts it as is."""
+    if isinstance(value, list):
+        return [escaped(v) for v in value]
+
+    return escape(value) if isinstance(value, str) and not isinstance(value, Markup) else value
+
+
+def assert_identical(component: Element, values: dict, compiled_values: dict = None):
+    compiled = CompiledTemplate(component)
+    compiled_values = values if compiled_values is None else compiled_values
+
+    expected = component.set_vars(**{name: escaped(value) for name, value in values.items()}).render(0)
+    assert compiled.render(**compiled_values) == expected
+    assert ''.join(compiled.render_iter(**compiled_values)) == expected
+
+
+@pytest.mark.parametrize('name', sorted(COMPONENTS))
+def test_defaults(name):
+    assert_identical(COMPONENTS[name], {})
+
+
+@pytest.mark.parametrize('kind', sorted(VALUES))
+@pytest.mark.parametrize('name', sorted(COMPONENTS))
+def test_values(name, kind):
+    component = COMPONENTS[name]
+
+    assert_identical(component, {var: VALUES[kind](var) for var in set.union(*slots(component))})
+
+
+@pytest.mark.parametrize('name', sorted(COMPONENTS))
+def test_element_values(name):
+    component = COMPONENTS[name]
+    content, attributes = slots(component)
+    text = {var: f'{var} value' for var in attributes}
+
+    assert_identical(component,
+                     {**{var: BADGE for var in content}, **text},
+                     {**{var: Markup(BADGE.render(0)) for var in content}, **text})
+
+
+@pytest.mark.parametrize('name', sorted(COMPONENTS))
+def test_list_values(name):
+    component = COMPONENTS[name]
+    content, attributes = slots(component)
+    text = {var: f'{var} value' for var in attributes}
+
+    assert_identical(component,
+                     {**{var: [BADGE, BUBBLE, 'text'] for var in content}, **text},
+                     {**{var: [Markup(BADGE.render(0)), Markup(BUBBLE.render(0)), 'text'] for var in content}, **text})
+
+
+def test_nested_defaults():
+    component = div('#outer', title=Var('title', 'default "title"'))[
+        Var('body', span('.inner', data_name=Var('name', 'nobody'))[b[Var('name', 'nobody')], Var('count', 0)]),
+        Var('tail', Var('fallback', 'tail'))
+    ]
+
+    assert_identical(component, {})
+    assert_identical(component, {'name': 'o"brien', 'count': 7})
+    assert_identical(component, {'title': Markup(escape('<"title">')), 'fallback': 'fell back'})
+    assert_identical(component, {'body': BUBBLE, 'tail': 'end'}, {'body': Markup(BUBBLE.render(0)), 'tail': 'end'})
+
+
+def test_iterator_values():
+    compiled = CompiledTemplate(views.ACTIVE_CHAT)
+    bubbles = [Markup(BUBBLE.render(0))] * 500
+
+    expected = views.ACTIVE_CHAT.set_vars(active_chat_messages=[BUBBLE] * 500).render(0)
+    assert ''.join(compiled.render_iter(active_chat_messages=iter(bubbles))) == expected
+
+
+def test_text_is_escaped():
+    compiled = CompiledTemplate(div('#out', title=Var('title'))[Var('body')])
+
+    assert compiled.render(title='"><script>', body='<script>alert(1)</script>') == \
+        '<div id="out" title="&quot;&gt;&lt;script&gt;">&lt;script&gt;alert(1)&lt;/script&gt;</div>'
+    assert compiled.render(title='t', body=Markup('<b>bold</b>')) == '<div id="out" title="t"><b>bold</b></div>'
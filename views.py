@@ -108,6 +108,16 @@ LOGIN = div('.row.valign-wrapper', style='height: 100vh;')[
     ]
 ]
 
+# unread badge of a sidebar entry; the wrapper keeps its id so it can be cleared on its own
+CHAT_UNREAD = span(id=Var('chat_unread_id'))[Var('chat_unread_badge', '')]
+
+CHAT_UNREAD_BADGE = span('.new.badge')[Var('chat_unread_count')]
+
+CHAT_UNREAD_UPDATE = CHAT_UNREAD(hx_swap_oob='outerHTML')
+
+# marks the open chat as read as soon as a pushed message lands in it
+READ_MARKER = div(hx_put=Var('read_marker_url'), hx_trigger='load', hx_swap='none')
+
 CHAT = a('.collection-item.valign-wrapper',
          id=Var('chat_id'),
          href='#',
@@ -120,10 +130,39 @@ CHAT = a('.collection-item.valign-wrapper',
             div('.truncate')[b[Var('chat_title', 'not set')]],
             div('.truncate', style='width: 180px')[Var('chat_latest_text', 'not set.')]
         ],
-        div('.col')[Var('chat_latest_time', '99:99')]
+        div('.col')[Var('chat_latest_time', '99:99')],
+        div('.col')[CHAT_UNREAD]
+    ]
+]
+
+# sidebar entry refreshed in place, and a brand-new one appended to the sidebar
+CHAT_UPDATE = CHAT(hx_swap_oob='innerHTML')
+
+CHAT_APPEND = div(hx_swap_oob='beforeend:#chats')[CHAT]
+
+SEARCH_RESULT = a('.collection-item',
+                  href='#',
+                  hx_get=Var('search_result_url'),
+                  hx_target='#active-chat',
+                  hx_swap='outerHTML')[
+    div('.row', style='margin-bottom: 0')[
+        div('.col', style='width: 100%')[
+            div('.truncate')[b[Var('search_result_title')], span('.grey-text.right')[Var('search_result_time')]],
+            div('.grey-text.text-darken-1')[Var('search_result_sender'), ': ', Var('search_result_snippet')]
+        ]
     ]
 ]
 
+# fetches the next page of search results once it scrolls into view
+SEARCH_MORE = div('.collection-item.center-align.grey-text',
+                  hx_get=Var('search_more_url'),
+                  hx_trigger='intersect once',
+                  hx_swap='outerHTML')[
+    'Loading more results...'
+]
+
+SEARCH_EMPTY = div('.collection-item.center-align.grey-text')['No messages found.']
+
 CHAT_DATE = div('.row', style='margin: 0')[
     p('.center-align')[Var('chat_date')]
 ]
@@ -155,6 +194,19 @@ CHAT_MESSAGE_SENT = div('.row', style='margin: 0')[
     ]
 ]
 
+# appends a message bubble to the #messages of the chat whose chat-target matches
+CHAT_MESSAGE_APPEND = div('.row', style='margin: 0', hx_swap_oob=Var('chat_message_append_target'))[
+    Var('chat_message_append_bubble')
+]
+
+LOAD_OLDER = div('.row.center-align.grey-text',
+                 style='margin: 0',
+                 hx_get=Var('load_older_url'),
+                 hx_trigger='intersect once',
+                 hx_swap='outerHTML')[
+    'Loading older messages...'
+]
+
 _SIDEBAR_WIDTH = px/300
 _ICON_WIDTH = px/50
 
@@ -185,15 +237,16 @@ ACTIVE_CHAT = div('#active-chat.col.teal.lighten-5',
         ]
     ],
     footer('.teal.darken-1.valign-wrapper', style=f'position: fixed; left: {_SIDEBAR_WIDTH}; bottom: 0; width: calc( 100% - {_SIDEBAR_WIDTH} );')[
-        form(style='margin: 0; width: 100%; height: 70px', onsubmit='return false;')[
+        form(style='margin: 0; width: 100%; height: 70px',
+             onsubmit='return false;',
+             hx_on__after_request="if (event.detail.successful) { this.reset(); var e = document.getElementById('active-chat'); e.scrollTop = e.scrollHeight; }")[
             div(',row', style='margin: 0')[
                 div('.input-field.col', style=f'width: calc( 100% - {_ICON_WIDTH} ); margin-top: 0.5rem; margin-bottom: 0.5rem')[
                     input('.validate.white-text',
                           name='message-content',
                           placeholder='Type a message',
                           hx_post=Var('active_chat_send_url'),
-                          hx_target='#active-chat',
-                          hx_swap='outerHTML',
+                          hx_swap='none',
                           hx_trigger="keyup[key=='Enter']")
                 ],
                 div('.input-field.col', style='margin-top: 0.5rem; margin-bottom: 0.5rem')[
@@ -202,8 +255,7 @@ ACTIVE_CHAT = div('#active-chat.col.teal.lighten-5',
                     a('.teal-text.text-lighten-3.valign-wrapper',
                       href='#',
                       hx_post=Var('active_chat_send_url'),
-                      hx_target='#active-chat',
-                      hx_swap='outerHTML')[
+                      hx_swap='none')[
                         div('.valign-wrapper', style='height: 54px')[i('.material-icons')['send']]
                     ]
                 ]
@@ -212,6 +264,8 @@ ACTIVE_CHAT = div('#active-chat.col.teal.lighten-5',
     ]
 ]
 
+ACTIVE_CHAT_OOB = ACTIVE_CHAT(hx_swap_oob='outerHTML')
+
 ADD_PRIVATE_MODAL = form('#add-private-modal.modal', onsubmit='return false;')[
     input(name='current-user', value=Var('add_private_modal_current_user', ''), type='hidden')[''],
     div('.modal-content')[
@@ -356,6 +410,17 @@ MAIN = div(style='height: 100vh')[
                         ADD_PRIVATE_MODAL
                     ]
                 ],
+                div('.collection-item', style='padding: 0 1rem')[
+                    input(type='search',
+                          name='query',
+                          placeholder='Search messages',
+                          autocomplete='off',
+                          style='margin: 0',
+                          hx_get=Var('main_search_url'),
+                          hx_trigger='input changed delay:300ms, search',
+                          hx_target='#search-results')
+                ],
+                div('#search-results', style='max-height: 50vh; overflow: auto'),
                 div('.divider'),
                 div('#chats')[Var('main_chats')]
             ],
@@ -0,0 +1,156 @@
+from concurrent.futures import Future
+import logging
+from queue import Empty, Queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+Write = Callable[[sqlite3.Connection], Any]
+
+# marks that the writer thread has no queued item in hand
+NOTHING = object()
+
+
+class BatchWriter:
+    """Runs writes on one connection from a single thread, committing them in groups.
+
+    `submit` queues a write and returns a future. The writer thread takes the writes
+    queued within `batch_interval` seconds of the first one, up to `batch_size`, and runs
+    them in one transaction, each in its own savepoint so that a failing write only fails
+    its own future. Futures are resolved once the transaction has committed, i.e. once
+    the write is as durable as the connection's `synchronous` setting makes it.
+
+    With the default `batch_interval` of 0 the writer never waits: it commits whatever
+    queued up while the previous transaction was committing, so batches grow with load.
+
+    Writes submitted with `transaction=False` run on their own, between batches, and manage
+    their own transactions as on a connection in sqlite3's default mode; that is what
+    statements which cannot run inside a transaction, like some PRAGMAs, need.
+    """
+
+    def __init__(self,
+                 connection: sqlite3.Connection,
+                 batch_size: int = 64,
+                 batch_interval: float = 0) -> None:
+        # transactions are managed explicitly
+        connection.isolation_level = None
+        self.__con = connection
+        self.__batch_size = batch_size
+        self.__batch_interval = batch_interval
+
+        self.__queue: 'Queue[Optional[Tuple[Write, Future, bool]]]' = Queue()
+        self.__stats_lock = threading.Lock()
+        self.__counters = dict.fromkeys(('writes', 'failed_writes', 'batches'), 0)
+
+        self.__thread = threading.Thread(target=self.__run, name='database-writer', daemon=True)
+        self.__thread.start()
+
+    def submit(self, write: Write, transaction: bool = True) -> Future:
+        """Queue `write(connection)`; the future holds its return value once committed."""
+        future = Future()
+        self.__queue.put((write, future, transaction))
+
+        return future
+
+    def __run(self):
+        item = self.__queue.get()
+        while item is not None:
+            write, future, transaction = item
+            if not transaction:
+                self.__run_alone(write, future)
+                item = self.__queue.get()
+                continue
+
+            batch = [(write, future)]
+            # the sentinel or a write that cannot join the batch ends it early and is handled next
+            item = NOTHING
+            deadline = time.monotonic() + self.__batch_interval
+            while len(batch) < self.__batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self.__queue.get(timeout=timeout) if timeout > 0 else self.__queue.get_nowait()
+                except Empty:
+                    item = NOTHING
+                    break
+
+                if item is None or not item[2]:
+                    break
+                batch.append(item[:2])
+                item = NOTHING
+
+            self.__commit(batch)
+            if item is NOTHING:
+                item = self.__queue.get()
+
+    def __run_alone(self, write: Write, future: Future):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        self.__con.isolation_level = ''
+        try:
+            with self.__con:
+                result = write(self.__con)
+        except Exception as e:
+            future.set_exception(e)
+            self.__count('failed_writes')
+        else:
+            future.set_result(result)
+            self.__count('writes')
+        finally:
+            self.__con.isolation_level = None
+
+    def __commit(self, batch: List[Tuple[Write, Future]]):
+        results = []
+        try:
+            self.__con.execute('BEGIN IMMEDIATE;')
+            for write, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                self.__con.execute('SAVEPOINT write;')
+                try:
+                    results.append((future, write(self.__con)))
+                    self.__con.execute('RELEASE write;')
+                except Exception as e:
+                    self.__con.execute('ROLLBACK TO write;')
+                    self.__con.execute('RELEASE write;')
+                    future.set_exception(e)
+                    self.__count('failed_writes')
+            self.__con.execute('COMMIT;')
+        except Exception as e:
+            # keep the writer alive; the batch's callers get the error
+            logging.exception('Batch commit failed.')
+            if self.__con.in_transaction:
+                self.__con.execute('ROLLBACK;')
+
+            # everything in the batch that has not failed on its own is lost with the transaction
+            failed = 0
+            for _, future in batch:
+                if not future.done() and (future.running() or future.set_running_or_notify_cancel()):
+                    future.set_exception(e)
+                    failed += 1
+            self.__count('failed_writes', failed)
+            return
+
+        for future, result in results:
+            future.set_result(result)
+        self.__count('writes', len(results))
+        self.__count('batches')
+
+    def __count(self, name: str, n: int = 1):
+        with self.__stats_lock:
+            self.__counters[name] += n
+
+    def stats(self) -> Dict[str, int]:
+        with self.__stats_lock:
+            counters = dict(self.__counters)
+
+        return {'queue_depth': self.__queue.qsize(), **counters}
+
+    def close(self):
+        """Commit the writes queued so far, then stop the writer thread and close its connection."""
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__con.close()